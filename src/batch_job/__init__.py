@@ -4,4 +4,8 @@ VERSION_OFFSET = 1000000
 
 REVISION_OFFSET = 1000000
 
-TEMP_DIR = '/BatchJobTemp'
\ No newline at end of file
+TEMP_DIR = '/BatchJobTemp'
+
+CACHE_DIR = '/BatchJobCache'
+
+CONNECTION_POOL_SIZE = 10
\ No newline at end of file
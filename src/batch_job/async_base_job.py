@@ -0,0 +1,162 @@
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+import time
+from typing import AsyncIterator
+
+from batch_job.base_job import BaseJob, _NO_ITEM, get_last_item
+from batch_job.job_data import JobStatus
+
+
+class AsyncBaseJob(BaseJob):
+    '''
+    Base class for jobs with asyncio load_items, process_item and post_loop, e.g. for HTTP fan-out. JobRunner runs it on an event loop.
+    Up to max_workers process_item coroutines run concurrently, bounded by a semaphore. The job_states and save_results contract is the
+    same as BaseJob: last_processed only advances over contiguous finished items. job_data may be an AsyncJobData, whose coroutines are
+    awaited, or a JobData, whose calls run on a worker thread so the event loop is not blocked.
+    '''
+    async def load_items(self, last_processed: str) -> tuple[bool, list]:
+        return True, []
+
+    async def load_pages(self, last_processed: str) -> AsyncIterator[tuple[bool, list]]:
+        '''
+        See BaseJob.load_pages.
+        '''
+        drain_pages = self.job_inputs.get('drain_pages', False)
+        all_loaded, work_items = await self.load_items(last_processed)
+        while True:
+            if drain_pages:
+                work_items = self.track_page(work_items)
+            yield all_loaded, work_items
+            last_item = get_last_item(work_items)
+            if all_loaded or not drain_pages or last_item is _NO_ITEM:
+                break
+            all_loaded, work_items = await self.load_items(str(last_item))
+
+    async def process_item(self, work_item) -> bool:
+        raise NotImplementedError('process_item is not implemented.')
+
+    async def post_loop(self, run_date: datetime):
+        pass
+
+    async def run(self):
+        try:
+            self.start_time = datetime.now(timezone.utc)
+            return await self.internal_run()
+        except Exception as err:
+            return await self.handle_error(err)
+
+    async def handle_error(self, err: Exception):
+        self.suspend_on_error(err)
+        return await self.save_results(False)
+
+    async def call_job_data(self, func, *args):
+        if asyncio.iscoroutinefunction(func):
+            return await func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    async def check_dependencies(self, run_date: datetime) -> bool:
+        if not JobStatus.is_end_state(self.job_info['status']):
+            expected_data_ids, not_expected_data_ids = self.list_dependencies(run_date)
+            existing_data_ids = await self.call_job_data(self.job_data.files_exist, expected_data_ids + not_expected_data_ids) \
+                if expected_data_ids or not_expected_data_ids else set()
+            return self.match_dependencies(expected_data_ids, not_expected_data_ids, existing_data_ids)
+        return False
+
+    async def internal_run(self):
+        if not await self.check_dependencies(self.job_inputs['run_date']):
+            return True # If job is skipped due to dependencies or in not runnable status, return as success.
+
+        loop_start = time.monotonic()
+        all_loaded, item_count = await self.process_pages_async(self.load_pages(self.job_states['last_processed']))
+        self.record_item_seconds(time.monotonic() - loop_start, item_count)
+        await self.post_loop(self.job_inputs['run_date'])
+        self.complete_loop(all_loaded, item_count)
+        return await self.save_results(True)
+
+    async def call_with_limit_async(self, func, work, tokens: int = 1):
+        '''
+        See BaseJob.call_with_limit.
+        '''
+        retries = { 'throttled': 0, 'failed': 0 }
+        while True:
+            await self.rate_limiter.acquire_async(tokens)
+            try:
+                result = await func(work)
+            except Exception as err:
+                delay = self.get_retry_delay(err, retries)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.rate_limiter.succeed()
+            return result
+
+    async def process_pages_async(self, pages: AsyncIterator[tuple[bool, list]]) -> tuple[bool, int]:
+        all_loaded, item_count, page_number = True, 0, 0
+        try:
+            async for all_loaded, work_items in pages:
+                if page_number > 0:
+                    await self.checkpoint_states()
+                page_number += 1
+                item_count = await self.process_items_async(work_items, item_count)
+                if self.message:
+                    break
+        finally:
+            await pages.aclose()
+        return all_loaded, item_count
+
+    async def process_items_async(self, work_items, item_count: int = 0) -> int:
+        '''
+        Tasks are created in item order with at most twice max_workers pending and completed in order, see process_items_concurrently.
+        '''
+        max_concurrency = max(self.job_inputs.get('max_workers', 1), 1)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def process_with_limit(work_item):
+            async with semaphore:
+                return await self.call_with_limit_async(self.process_item, work_item)
+
+        item_iter = iter(work_items)
+        in_flight = deque()
+        all_submitted = False
+        try:
+            while True:
+                while not all_submitted and len(in_flight) < 2 * max_concurrency and item_count + len(in_flight) < self.batch_size:
+                    try:
+                        work_item = next(item_iter)
+                    except StopIteration:
+                        all_submitted = True
+                        break
+                    in_flight.append((work_item, asyncio.ensure_future(process_with_limit(work_item))))
+                if not in_flight:
+                    break
+                work_item, task = in_flight.popleft()
+                self.count_item(work_item, await task)
+                if self.is_checkpoint_due():
+                    await self.checkpoint_states()
+                item_count += 1
+                if self.check_limits(item_count):
+                    break
+        finally:
+            for _, task in in_flight:
+                task.cancel()
+            await asyncio.gather(*(task for _, task in in_flight), return_exceptions=True)
+        return item_count
+
+    async def checkpoint_states(self):
+        '''
+        See BaseJob.checkpoint_states, the tasks in flight keep running while the states are saved.
+        '''
+        self.stamp_states()
+        if self.info_saved:
+            await self.call_job_data(self.job_data.checkpoint_states, self.job_info)
+        else:
+            await self.call_job_data(self.job_data.upsert_info, self.job_info)
+            self.info_saved = True
+        self.reset_checkpoint()
+
+    async def save_results(self, success: bool) -> bool:
+        self.stamp_states()
+        await self.call_job_data(self.job_data.complete_run, success, self.job_info, self.message, self.start_time)
+        return success
@@ -0,0 +1,245 @@
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient, StorageStreamDownloader
+import asyncio
+import os
+
+from batch_job import CONNECTION_POOL_SIZE
+from batch_job.blob_store import CleanUpResult, DownloadResult, UploadResult, is_container_not_found, group_blob_ids, get_listing_prefix, get_unlisted, \
+    get_download_conditions, get_partial_path, remove_partial, is_seekable, BufferReader, MAX_DELETE_BATCH_SIZE, MAX_LISTED_PER_BLOB, DEFAULT_MAX_CONCURRENCY, DEFAULT_SINGLE_GET_SIZE, \
+    DEFAULT_CHUNK_GET_SIZE, DEFAULT_SINGLE_PUT_SIZE, DEFAULT_BLOCK_SIZE
+from batch_job.transport import create_async_transport
+
+
+class AsyncBlobStore:
+    def __init__(self, connection_string, pool_size=CONNECTION_POOL_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_single_get_size=DEFAULT_SINGLE_GET_SIZE, max_chunk_get_size=DEFAULT_CHUNK_GET_SIZE,
+                 max_single_put_size=DEFAULT_SINGLE_PUT_SIZE, max_block_size=DEFAULT_BLOCK_SIZE):
+        '''
+        The asyncio counterpart of BlobStore with the same methods as coroutines. The service client is created on first use
+        within the event loop and kept open until close() is awaited.
+        '''
+        self._connection_string = connection_string
+        self._pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.max_single_get_size = max_single_get_size
+        self.max_chunk_get_size = max_chunk_get_size
+        self.max_single_put_size = max_single_put_size
+        self.max_block_size = max_block_size
+        self._service_client = None
+        self._containers = {}
+        self._existing_containers = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @property
+    def service_client(self) -> BlobServiceClient:
+        if self._service_client is None:
+            self._service_client = BlobServiceClient.from_connection_string(self._connection_string, transport=create_async_transport(self._pool_size),
+                                                                            max_single_get_size=self.max_single_get_size,
+                                                                            max_chunk_get_size=self.max_chunk_get_size,
+                                                                            max_single_put_size=self.max_single_put_size,
+                                                                            max_block_size=self.max_block_size)
+        return self._service_client
+
+    async def close(self):
+        self._containers = {}
+        self._existing_containers = set()
+        if self._service_client is not None:
+            await self._service_client.close()
+            self._service_client = None
+
+    async def get_container_client(self, container_name, create_if_missing=False) -> ContainerClient:
+        container = self._containers.get(container_name)
+        if container is None:
+            container = self._containers.setdefault(container_name, self.service_client.get_container_client(container_name))
+        if create_if_missing and container_name not in self._existing_containers:
+            try:
+                await container.create_container()
+            except ResourceExistsError:
+                pass
+            self._existing_containers.add(container_name)
+        return container
+
+    def forget_container(self, container_name):
+        self._existing_containers.discard(container_name)
+
+    async def create_blob_client(self, container_name, blob_name, create_container=True):
+        return (await self.get_container_client(container_name, create_container)).get_blob_client(blob_name)
+
+    async def upload(self, container_name, blob_name, file_path, max_concurrency=None) -> UploadResult:
+        if not os.path.exists(file_path):
+            return UploadResult(UploadResult.FileNotFound)
+        with open(file_path, "rb") as data:
+            return await self.upload_stream(container_name, blob_name, data, max_concurrency=max_concurrency)
+
+    async def upload_bytes(self, container_name, blob_name, data, max_concurrency=None) -> UploadResult:
+        if not isinstance(data, bytes):
+            data = BufferReader(data)
+        return await self.upload_stream(container_name, blob_name, data, len(data), max_concurrency)
+
+    async def upload_stream(self, container_name, blob_name, stream, length: int = None, max_concurrency=None) -> UploadResult:
+        '''
+        See BlobStore.upload_stream, an async iterable of bytes chunks is accepted as well.
+        '''
+        start = stream.tell() if is_seekable(stream) else None
+        rewindable = start is not None or isinstance(stream, bytes)
+        try:
+            try:
+                response = await self.upload_once(container_name, blob_name, stream, length, max_concurrency)
+            except ResourceNotFoundError as err:
+                # The container was deleted since it was cached, recreate it and try once more.
+                if not is_container_not_found(err):
+                    raise
+                self.forget_container(container_name)
+                if not rewindable:
+                    raise
+                if start is not None:
+                    stream.seek(start)
+                response = await self.upload_once(container_name, blob_name, stream, length, max_concurrency)
+        except ResourceExistsError:
+            return UploadResult(UploadResult.AlreadyExists)
+        return UploadResult(UploadResult.Created, (response or {}).get('etag'))
+
+    async def upload_once(self, container_name, blob_name, data, length: int = None, max_concurrency=None) -> dict:
+        blob_client = await self.create_blob_client(container_name, blob_name)
+        return await blob_client.upload_blob(data, length=length, blob_type="BlockBlob", overwrite=False,
+                                             max_concurrency=max_concurrency or self.max_concurrency)
+
+    async def download(self, container_name, blob_name, file_path, max_concurrency=None, if_none_match: str = None) -> DownloadResult:
+        blob_client = await self.create_blob_client(container_name, blob_name, False)
+        try:
+            download_stream = await blob_client.download_blob(max_concurrency=max_concurrency or self.max_concurrency,
+                                                              **get_download_conditions(if_none_match))
+        except ResourceNotFoundError as err:
+            if is_container_not_found(err):
+                self.forget_container(container_name)
+            return DownloadResult(DownloadResult.NotFound)
+        except HttpResponseError as err:
+            # The service answers a matching If-None-Match with 304, which the SDK raises as ResourceModifiedError or HttpResponseError.
+            if err.status_code == 304:
+                return DownloadResult(DownloadResult.NotModified, if_none_match)
+            raise
+        partial_path = get_partial_path(file_path)
+        try:
+            with open(partial_path, "wb") as data:
+                await download_stream.readinto(data)
+            os.replace(partial_path, file_path)
+        finally:
+            remove_partial(partial_path)
+        return DownloadResult(DownloadResult.Downloaded, download_stream.properties.etag, download_stream.properties.size)
+
+    async def download_bytes(self, container_name, blob_name, max_concurrency=None) -> bytes:
+        download_stream = await self.open_read_stream(container_name, blob_name, max_concurrency)
+        return await download_stream.readall() if download_stream is not None else None
+
+    async def open_read_stream(self, container_name, blob_name, max_concurrency=None) -> StorageStreamDownloader:
+        '''
+        See BlobStore.open_read_stream, the stream methods are coroutines and chunks() is an async iterator.
+        '''
+        blob_client = await self.create_blob_client(container_name, blob_name, False)
+        try:
+            return await blob_client.download_blob(max_concurrency=max_concurrency or self.max_concurrency)
+        except ResourceNotFoundError as err:
+            if is_container_not_found(err):
+                self.forget_container(container_name)
+            return None
+
+    async def exists(self, container_name, blob_name) -> bool:
+        blob_client = await self.create_blob_client(container_name, blob_name, False)
+        return await blob_client.exists()
+
+    async def exists_many(self, blob_ids) -> set[tuple[str, str]]:
+        '''
+        See BlobStore.exists_many, the requests are run concurrently on the event loop.
+        '''
+        existing = set()
+        single_checks = []
+        listings = []
+        for container_name, blob_names in group_blob_ids(blob_ids).items():
+            prefix = get_listing_prefix(blob_names)
+            if prefix:
+                listings.append((container_name, prefix, blob_names))
+            else:
+                single_checks.extend((container_name, blob_name) for blob_name in blob_names)
+        listed = await asyncio.gather(*(self.list_existing(*listing) for listing in listings))
+        for (container_name, _, _), (found, unchecked) in zip(listings, listed):
+            existing.update((container_name, blob_name) for blob_name in found)
+            single_checks.extend((container_name, blob_name) for blob_name in unchecked)
+        found = await asyncio.gather(*(self.exists(*blob_id) for blob_id in single_checks))
+        existing.update(blob_id for blob_id, exists in zip(single_checks, found) if exists)
+        return existing
+
+    async def list_existing(self, container_name, prefix: str, blob_names: set[str]) -> tuple[set[str], set[str]]:
+        last_name = max(blob_names)
+        max_listed = len(blob_names) * MAX_LISTED_PER_BLOB
+        found = set()
+        listed = 0
+        container = await self.get_container_client(container_name)
+        try:
+            async for blob in container.list_blob_names(name_starts_with=prefix):
+                if blob > last_name:
+                    break
+                if listed >= max_listed:
+                    return found, get_unlisted(blob_names, blob)
+                listed += 1
+                if blob in blob_names:
+                    found.add(blob)
+        except ResourceNotFoundError as err:
+            if not is_container_not_found(err):
+                raise
+            self.forget_container(container_name)
+        return found, set()
+
+    async def delete(self, container_name, blob_name) -> bool:
+        blob_client = await self.create_blob_client(container_name, blob_name, False)
+        try:
+            await blob_client.delete_blob()
+            return True
+        except ResourceNotFoundError as err:
+            if is_container_not_found(err):
+                self.forget_container(container_name)
+            return False
+
+    async def clean_up(self, container_name, least_blob_name: str, prefix: str = None, max_deletes: int = None) -> CleanUpResult:
+        '''
+        See BlobStore.clean_up.
+        '''
+        container = await self.get_container_client(container_name)
+        result = CleanUpResult()
+
+        async def delete_batch(batch):
+            responses = await container.delete_blobs(*[ name for name, _ in batch ], raise_on_any_failure=False)
+            result.count_batch(batch, [ response.status_code async for response in responses ])
+
+        batch = []
+        queued = 0
+        try:
+            async for blob in container.list_blobs(name_starts_with=prefix):
+                if blob.name >= least_blob_name:
+                    break
+                if max_deletes is not None and queued >= max_deletes:
+                    result.stopped_early = True
+                    break
+                batch.append((blob.name, blob.size))
+                queued += 1
+                if len(batch) == MAX_DELETE_BATCH_SIZE:
+                    await delete_batch(batch)
+                    batch = []
+            if batch:
+                await delete_batch(batch)
+        except ResourceNotFoundError as err:
+            if not is_container_not_found(err):
+                raise
+            self.forget_container(container_name)
+        return result
+
+    async def lease_blob(self, container_name, blob_name, lease_duration=15):
+        blob_client = await self.create_blob_client(container_name, blob_name, False)
+        try:
+            return await blob_client.acquire_lease(lease_duration=lease_duration)
+        except HttpResponseError:
+            pass
@@ -0,0 +1,211 @@
+from azure.data.tables import UpdateMode
+from collections import deque
+from datetime import datetime
+import os
+from typing import AsyncIterable, AsyncIterator, BinaryIO, Callable, Iterable, Union
+
+from batch_job import TEMP_DIR, CONNECTION_POOL_SIZE
+from batch_job.async_blob_store import AsyncBlobStore
+from batch_job.async_table_store import AsyncTableStore, create_async_table_service_client
+from batch_job.blob_store import UploadResult
+from batch_job.exists_cache import ExistsCache
+from batch_job.job_data import BaseJobData, JobInfo, JobRun, JobStatus, INFO_SUMMARY_COLUMNS, RUN_FAILURE_COLUMNS, INVERTED_RUN_KEY_FLOOR, has_failure_counters
+
+
+class AsyncJobData(BaseJobData):
+    def __init__(self, conn_str: str, temp_dir: str=TEMP_DIR, pool_size: int=CONNECTION_POOL_SIZE, inverted_run_keys: bool=False,
+                 exists_cache: ExistsCache=None):
+        '''
+        The asyncio counterpart of JobData with the same methods as coroutines. It must be created within a running event loop,
+        and closed with close() or async with.
+        '''
+        self.table_service = create_async_table_service_client(conn_str, pool_size)
+        self.info_store = AsyncTableStore(conn_str, "JobInfo", self.table_service)
+        self.run_store = AsyncTableStore(conn_str, "JobRun", self.table_service)
+        self.blob_store = AsyncBlobStore(conn_str, pool_size)
+        super().__init__(temp_dir, inverted_run_keys, exists_cache)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        await self.info_store.close()
+        await self.run_store.close()
+        await self.table_service.close()
+        await self.blob_store.close()
+
+    async def create_if_not_exist(self):
+        await self.info_store.create_if_not_exist()
+        await self.run_store.create_if_not_exist()
+
+    async def upsert_info(self, data: JobInfo):
+        if await self.info_store.upsert_entity(data):
+            return data
+
+    async def get_info(self, job_id: str):
+        return await self.info_store.get_entity(self.get_partition_key(job_id), job_id)
+
+    async def info_exists(self, job_id: str) -> bool:
+        return await self.info_store.get_entity(self.get_partition_key(job_id), job_id, select=['RowKey']) is not None
+
+    def list_infos(self, job_name: str, select: list[str] = None, results_per_page: int = None) -> AsyncIterator[JobInfo]:
+        return self.info_store.iter_entities(job_name, select=select, results_per_page=results_per_page)
+
+    def list_active_infos(self, job_name: str, select: list[str] = None, results_per_page: int = None) -> AsyncIterator[JobInfo]:
+        query_filter, parameters = self.get_active_filter()
+        return self.info_store.iter_entities(job_name, select=select, results_per_page=results_per_page,
+                                             query_filter=query_filter, parameters=parameters)
+
+    def list_runs(self, job_id: str, select: list[str] = None, results_per_page: int = None) -> AsyncIterator[JobRun]:
+        return self.run_store.iter_entities(job_id, select=select, results_per_page=results_per_page)
+
+    async def latest_runs(self, job_id: str, n: int, select: list[str] = None) -> list[JobRun]:
+        '''
+        See JobData.latest_runs.
+        '''
+        runs = []
+        inverted_runs = self.run_store.iter_entities(job_id, INVERTED_RUN_KEY_FLOOR, select=select, results_per_page=n)
+        async for run in inverted_runs:
+            runs.append(run)
+            if len(runs) >= n:
+                await inverted_runs.aclose()
+                return runs
+        legacy_runs = deque(maxlen=n - len(runs))
+        async for run in self.run_store.iter_entities(job_id, select=select, query_filter='RowKey lt @floor',
+                                                      parameters={ 'floor': INVERTED_RUN_KEY_FLOOR }):
+            legacy_runs.append(run)
+        runs.extend(reversed(legacy_runs))
+        return runs
+
+    async def set_status(self, job_info: JobInfo, status: str, current_time: datetime):
+        if await self.info_store.upsert_entity(self.get_status_update(job_info, status, current_time), UpdateMode.MERGE):
+            return job_info
+
+    async def set_statuses(self, job_infos: list[JobInfo], status: str, current_time: datetime) -> list[JobInfo]:
+        operations = [ ('upsert', self.get_status_update(job_info, status, current_time), { 'mode': UpdateMode.MERGE }) for job_info in job_infos ]
+        await self.info_store.submit_transaction(operations)
+        return job_infos
+
+    async def checkpoint_states(self, job_info: JobInfo):
+        if await self.info_store.upsert_entity({ key: job_info[key] for key in ['PartitionKey', 'RowKey', 'states', 'update_time'] }, UpdateMode.MERGE):
+            return job_info
+
+    async def expire_job(self, job_info: JobInfo, current_time: datetime):
+        return await self.set_status(job_info, JobStatus.Expired, current_time)
+
+    async def expire_jobs(self, job_infos: list[JobInfo], current_time: datetime) -> list[JobInfo]:
+        return await self.set_statuses(job_infos, JobStatus.Expired, current_time)
+
+    async def fail_job(self, job_info: JobInfo, current_time: datetime):
+        return await self.set_status(job_info, JobStatus.Failed, current_time)
+
+    async def fail_jobs(self, job_infos: list[JobInfo], current_time: datetime) -> list[JobInfo]:
+        return await self.set_statuses(job_infos, JobStatus.Failed, current_time)
+
+    async def complete_run(self, success: bool, job_info: JobInfo, message: str, start_time: datetime):
+        if not has_failure_counters(job_info):
+            job_info['consecutive_failures'], job_info['total_failures'] = await self.count_failures(job_info['RowKey'])
+        self.update_failure_counters(success, job_info)
+        await self.insert_run(job_info['RowKey'], start_time, job_info['update_time'], message, job_info['status'], not success)
+        await self.upsert_info(job_info)
+
+    async def insert_run(self, job_id: str, start_time: datetime, end_time: datetime, message: str, end_status: str, is_error: bool = False):
+        job_run = self.create_run(job_id, start_time, end_time, message, end_status, is_error)
+        if await self.run_store.insert_entity(job_run):
+            return job_run
+
+    async def insert_runs(self, job_runs: list[JobRun]) -> list[JobRun]:
+        await self.run_store.submit_transaction([ ('create', job_run) for job_run in job_runs ])
+        return job_runs
+
+    async def summarize_failures(self, job_info: JobInfo) -> tuple[int, int]:
+        if not has_failure_counters(job_info):
+            await self.backfill_failures(job_info)
+        return job_info['consecutive_failures'], job_info['total_failures']
+
+    async def count_failures(self, job_id: str) -> tuple[int, int]:
+        return self.summarize_runs([ run async for run in self.list_runs(job_id, RUN_FAILURE_COLUMNS) ])
+
+    async def backfill_failures(self, job_info: JobInfo):
+        job_info['consecutive_failures'], job_info['total_failures'] = await self.count_failures(job_info['RowKey'])
+        if await self.info_store.upsert_entity(self.get_failure_counters(job_info), UpdateMode.MERGE):
+            return job_info
+
+    async def backfill_all_failures(self, job_name: str) -> int:
+        backfilled = 0
+        async for job_info in self.list_infos(job_name, INFO_SUMMARY_COLUMNS):
+            if not has_failure_counters(job_info):
+                await self.backfill_failures(job_info)
+                backfilled += 1
+        return backfilled
+
+    async def upload_file(self, container_name: str, blob_name: str, create_file_func: Callable[[str], bool]) -> UploadResult:
+        file_path = self.get_temp_file_path(container_name, blob_name)
+        if create_file_func(file_path):
+            try:
+                return await self.blob_store.upload(container_name, blob_name, file_path)
+            finally:
+                self.invalidate_exists(container_name, blob_name)
+        return UploadResult(UploadResult.FileNotFound)
+
+    async def upload_bytes(self, container_name: str, blob_name: str, data: Union[bytes, bytearray, memoryview]) -> UploadResult:
+        try:
+            return await self.blob_store.upload_bytes(container_name, blob_name, data)
+        finally:
+            self.invalidate_exists(container_name, blob_name)
+
+    async def upload_stream(self, container_name: str, blob_name: str, stream: Union[BinaryIO, Iterable[bytes], AsyncIterable[bytes]],
+                            length: int = None) -> UploadResult:
+        try:
+            return await self.blob_store.upload_stream(container_name, blob_name, stream, length)
+        finally:
+            self.invalidate_exists(container_name, blob_name)
+
+    async def download_bytes(self, container_name: str, blob_name: str) -> bytes:
+        return await self.blob_store.download_bytes(container_name, blob_name)
+
+    async def open_read_stream(self, container_name: str, blob_name: str):
+        return await self.blob_store.open_read_stream(container_name, blob_name)
+
+    async def download_file(self, container_name: str, blob_name: str, load_data_func: Callable[[str], object]) -> object:
+        file_path = self.get_temp_file_path(container_name, blob_name)
+        if not os.path.exists(file_path):
+            await self.blob_store.download(container_name, blob_name, file_path)
+        if os.path.exists(file_path) and load_data_func:
+            return load_data_func(file_path)
+
+    async def delete_file(self, container_name: str, blob_name: str):
+        file_path = self.get_temp_file_path(container_name, blob_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            return await self.blob_store.delete(container_name, blob_name)
+        finally:
+            self.invalidate_exists(container_name, blob_name)
+
+    async def file_exists(self, container_name: str, blob_name: str) -> bool:
+        if self.exists_cache is None:
+            return await self.blob_store.exists(container_name, blob_name)
+        exists = self.exists_cache.get((container_name, blob_name))
+        if exists is None:
+            generation = self.exists_cache.get_generation((container_name, blob_name))
+            exists = await self.blob_store.exists(container_name, blob_name)
+            self.exists_cache.put((container_name, blob_name), exists, generation)
+        return exists
+
+    async def files_exist(self, blob_ids) -> set[tuple[str, str]]:
+        if self.exists_cache is None:
+            return await self.blob_store.exists_many(blob_ids)
+        existing, unknown = self.exists_cache.lookup(blob_ids)
+        if unknown:
+            generations = self.exists_cache.get_generations(unknown)
+            found = await self.blob_store.exists_many(unknown)
+            self.exists_cache.update(unknown, found, generations)
+            existing |= found
+        return existing
+
+    async def lease_job(self, job_type: str, lease_duration: int = 15):
+        return await self.blob_store.lease_blob('BatchJobAdmin', job_type, lease_duration)
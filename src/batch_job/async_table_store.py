@@ -0,0 +1,109 @@
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+from azure.data.tables import UpdateMode
+from azure.data.tables.aio import TableServiceClient, TableClient
+from typing import AsyncIterator
+
+from batch_job import CONNECTION_POOL_SIZE
+from batch_job.table_store import build_partition_query, split_transactions
+from batch_job.transport import create_async_transport
+
+
+def create_async_table_service_client(conn_str: str, pool_size: int = CONNECTION_POOL_SIZE) -> TableServiceClient:
+    '''
+    Async version of create_table_service_client. It must be called with a running event loop.
+    '''
+    return TableServiceClient.from_connection_string(conn_str, transport=create_async_transport(pool_size))
+
+
+class AsyncTableStore(object):
+    def __init__(self, conn_str: str, table_name: str, service_client: TableServiceClient = None, pool_size: int = CONNECTION_POOL_SIZE):
+        '''
+        The asyncio counterpart of TableStore with the same methods as coroutines. The clients are created on first use
+        within the event loop and kept open until close() is awaited.
+        '''
+        self.connection_string = conn_str
+        self.table_name = table_name
+        self.pool_size = pool_size
+        self._service_client = service_client
+        self._owns_service_client = service_client is None
+        self._table_client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    @property
+    def service_client(self) -> TableServiceClient:
+        if self._service_client is None:
+            self._service_client = create_async_table_service_client(self.connection_string, self.pool_size)
+        return self._service_client
+
+    @property
+    def table_client(self) -> TableClient:
+        if self._table_client is None:
+            self._table_client = self.service_client.get_table_client(self.table_name)
+        return self._table_client
+
+    async def close(self):
+        if self._table_client is not None:
+            await self._table_client.close()
+            self._table_client = None
+        if self._owns_service_client and self._service_client is not None:
+            await self._service_client.close()
+            self._service_client = None
+
+    async def create_if_not_exist(self) -> TableClient:
+        await self.service_client.create_table_if_not_exists(table_name=self.table_name)
+        return self.table_client
+
+    async def delete_table(self):
+        return await self.service_client.delete_table(table_name=self.table_name)
+
+    async def insert_entity(self, data) -> bool:
+        try:
+            return await self.table_client.create_entity(entity=data)
+        except ResourceExistsError:
+            return None
+
+    async def upsert_entity(self, data, update_mode: UpdateMode = UpdateMode.REPLACE):
+        return await self.table_client.upsert_entity(mode=update_mode, entity=data)
+
+    async def delete_entity(self, partition_key, row_key):
+        return await self.table_client.delete_entity(row_key=row_key, partition_key=partition_key)
+
+    async def get_entity(self, partition_key, row_key, select: list[str] = None):
+        try:
+            return await self.table_client.get_entity(row_key=row_key, partition_key=partition_key, select=select)
+        except ResourceNotFoundError:
+            return None
+
+    async def query_pages(self, partition_key, rk_continuation_token="", select: list[str] = None, results_per_page: int = None,
+                          query_filter: str = None, parameters: dict = None, continuation_token=None) -> AsyncIterator[tuple[list, object]]:
+        '''
+        See TableStore.query_pages.
+        '''
+        full_filter, all_parameters = build_partition_query(partition_key, rk_continuation_token, query_filter, parameters)
+        pager = self.table_client.query_entities(full_filter, parameters=all_parameters, select=select,
+                                                 results_per_page=results_per_page).by_page(continuation_token=continuation_token)
+        async for page in pager:
+            yield [ entity async for entity in page ], pager.continuation_token
+
+    async def iter_entities(self, partition_key, rk_continuation_token="", select: list[str] = None, results_per_page: int = None,
+                            query_filter: str = None, parameters: dict = None) -> AsyncIterator:
+        async for entities, _ in self.query_pages(partition_key, rk_continuation_token, select, results_per_page, query_filter, parameters):
+            for entity in entities:
+                yield entity
+
+    async def query_entities(self, partition_key, rk_continuation_token=""):
+        return [ entity async for entity in self.iter_entities(partition_key, rk_continuation_token) ]
+
+    async def submit_transaction(self, operations: list) -> list:
+        '''
+        See TableStore.submit_transaction.
+        '''
+        results = []
+        for transaction in split_transactions(operations):
+            results.extend(await self.table_client.submit_transaction(transaction))
+        return results
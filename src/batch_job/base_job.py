@@ -1,22 +1,106 @@
+from collections import deque
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from itertools import islice
 import pickle
+import threading
 import time
+from typing import Iterator
 from typing_extensions import TypedDict
 
 from batch_job import VERSION_OFFSET, REVISION_OFFSET
 from batch_job.job_data import JobInfo, JobData, JobStatus
+from batch_job.rate_limiter import TokenBucket, get_retry_after, is_throttled
+from batch_job.retry_policy import RetryPolicy
+
+
+_NO_ITEM = object()
+
+DEFAULT_CHUNK_SIZE = 100
+
+DEFAULT_THROTTLE_RETRIES = 5
+
+# The weight of the latest run in the moving average of seconds per item.
+ITEM_SECONDS_SMOOTHING = 0.5
+
+
+def prefetch_pages(pages: Iterator, depth: int) -> Iterator:
+    '''
+    Pull up to depth pages ahead from a background thread while the caller handles the current one. The pages are still pulled in order
+    by a single thread, so the page iterator does not need to be thread-safe. Errors are raised to the caller when it reaches that page.
+    '''
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch')
+    pending = deque([executor.submit(next, pages, _NO_ITEM)])
+    try:
+        while True:
+            page = pending.popleft().result()
+            if page is _NO_ITEM:
+                break
+            while len(pending) < depth:
+                pending.append(executor.submit(next, pages, _NO_ITEM))
+            yield page
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        if hasattr(pages, 'close'):
+            pages.close()
+
+
+class TrackedPage(object):
+    def __init__(self, work_items):
+        '''
+        Hand out the items of a page from any iterable, e.g. a generator, and remember the last one so the next page can be loaded after it.
+        '''
+        self._items = iter(work_items)
+        self.last_item = _NO_ITEM
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.last_item = next(self._items)
+        return self.last_item
+
+
+def get_last_item(work_items):
+    '''
+    The last item of a handled page, or _NO_ITEM if it is empty.
+    '''
+    if isinstance(work_items, TrackedPage):
+        return work_items.last_item
+    return work_items[-1] if work_items else _NO_ITEM
 
 
 class BaseJobInputs(TypedDict): 
     run_date: datetime
     batch_size: int
-    process_interval: float
+    process_interval: float  # used as a rate of 1/process_interval items per second if rate_limit is not set
+    rate_limit: float  # items per second on average, no limit if 0
+    rate_burst: int  # items allowed at once above the average rate
+    max_throttle_retries: int  # times to retry an item after the downstream throttles
+    retry_max_attempts: int  # attempts in total for an item failing with a retryable error, no retry if 1
+    retry_base_seconds: float  # the longest wait before the first retry, doubled for each further retry
+    retry_max_seconds: float  # the longest wait before any retry
+    retryable_errors: list[str]  # dotted paths of the error classes to retry, all errors if empty
+    max_workers: int  # process items on a thread pool if more than 1
+    process_chunk_size: int  # number of items for each process_batch call
+    drain_pages: bool  # keep calling load_items in the same run while it is not all loaded
+    max_run_seconds: float  # suspend the run after this time budget, no limit if 0
+    prefetch_pages: int  # number of pages loaded ahead on a background thread, no prefetch if 0
+    checkpoint_items: int  # save the states after this many items, no item-based checkpoint if 0
+    checkpoint_seconds: float  # save the states after this many seconds, no time-based checkpoint if 0
+    adaptive_batch_size: bool  # lower the batch size to fit max_run_seconds with avg_item_seconds in states, batch_size is the upper bound
 
 
 class BaseJobStates(TypedDict):
     last_processed: str
     processed: int
     skipped: int
+    avg_item_seconds: float  # only kept with adaptive_batch_size
+    retries: int  # only kept once an item is retried
+
 
 
 class BaseJob(object):
@@ -26,9 +110,86 @@ class BaseJob(object):
         self.message = ''
         self.job_info = job_info
         self.job_data = job_data
+        self.batch_size = self.get_batch_size()
+        self.rate_limiter = self.create_rate_limiter()
+        self.retry_policy = self.create_retry_policy()
+        self.states_lock = threading.Lock()
+        self.items_since_checkpoint = 0
+        self.checkpoint_time = time.monotonic()
+        self.info_saved = False
 
     def get_type(self) -> str:
         return self.__class__.__name__
+
+    def get_batch_size(self) -> int:
+        '''
+        The batch_size setting, or with adaptive_batch_size the number of items expected to fit max_run_seconds at the average seconds
+        per item of previous runs if it is smaller. batch_size is an upper bound, it is never raised.
+        '''
+        batch_size = self.job_inputs['batch_size']
+        max_run_seconds = self.job_inputs.get('max_run_seconds', 0)
+        avg_item_seconds = self.job_states.get('avg_item_seconds', 0)
+        if self.job_inputs.get('adaptive_batch_size', False) and max_run_seconds > 0 and avg_item_seconds > 0:
+            batch_size = min(batch_size, max(1, int(max_run_seconds / avg_item_seconds)))
+        return batch_size
+
+    def create_rate_limiter(self) -> TokenBucket:
+        rate, burst = self.job_inputs.get('rate_limit', 0), self.job_inputs.get('rate_burst', 1)
+        if rate <= 0 and self.job_inputs.get('process_interval', 0) > 0:
+            rate, burst = 1 / self.job_inputs['process_interval'], 1
+        return TokenBucket(rate, burst)
+
+    def create_retry_policy(self) -> RetryPolicy:
+        from batch_job.job_settings import import_string # job_settings imports this module
+        retryable = tuple(import_string(name) for name in self.job_inputs.get('retryable_errors', None) or []) or (Exception,)
+        return RetryPolicy(self.job_inputs.get('retry_max_attempts', 1), self.job_inputs.get('retry_base_seconds', 1.0),
+                           self.job_inputs.get('retry_max_seconds', 60.0), retryable)
+
+    def call_with_limit(self, func, work, tokens: int = 1):
+        '''
+        Call process_item or process_batch within the rate limit and retry it on errors, see get_retry_delay. Only an error that is not
+        retried ends the iteration.
+        '''
+        retries = { 'throttled': 0, 'failed': 0 }
+        while True:
+            self.rate_limiter.acquire(tokens)
+            try:
+                result = func(work)
+            except Exception as err:
+                delay = self.get_retry_delay(err, retries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self.rate_limiter.succeed()
+            return result
+
+    def get_retry_delay(self, err: Exception, retries: dict) -> float:
+        '''
+        Return the seconds to wait before retrying a failed call, or None if it is not retried.
+        - If the downstream throttles, all workers back off and the call is retried up to max_throttle_retries times.
+        - Other errors are retried by the retry policy, the retries are counted in job_states.
+        '''
+        if is_throttled(err):
+            if retries['throttled'] >= self.job_inputs.get('max_throttle_retries', DEFAULT_THROTTLE_RETRIES):
+                return None
+            retries['throttled'] += 1
+            self.rate_limiter.throttle(get_retry_after(err))
+            return 0
+        if not self.retry_policy.should_retry(err, retries['failed'] + 1):
+            return None
+        retries['failed'] += 1
+        with self.states_lock:
+            self.job_states['retries'] = self.job_states.get('retries', 0) + 1
+        return self.retry_policy.get_delay(retries['failed'])
+
+    def record_item_seconds(self, elapsed_seconds: float, item_count: int):
+        if self.job_inputs.get('adaptive_batch_size', False) and item_count > 0:
+            item_seconds = elapsed_seconds / item_count
+            avg_item_seconds = self.job_states.get('avg_item_seconds', 0)
+            if avg_item_seconds > 0:
+                item_seconds = ITEM_SECONDS_SMOOTHING * item_seconds + (1 - ITEM_SECONDS_SMOOTHING) * avg_item_seconds
+            self.job_states['avg_item_seconds'] = item_seconds
     
     def list_expected(self, run_date: datetime) -> list[tuple[str, str]]:
         return []
@@ -38,20 +199,28 @@ class BaseJob(object):
 
     def check_dependencies(self, run_date: datetime) -> bool:
         if not JobStatus.is_end_state(self.job_info['status']):
-            # Check required data
-            for expected_data_id in self.list_expected(run_date):
-                if not self.job_data.file_exists(*expected_data_id):
-                    self.message = 'Job {0} expects data {1}/{2} but it does not exist.'.format(self.get_type(), *expected_data_id)
-                    return False
-            # Check unexpected data
-            for not_expected_data_id in self.list_not_expected(run_date):
-                if self.job_data.file_exists(*not_expected_data_id):
-                    self.message = 'Job {0} does not expect data {1}/{2} but it exists.'.format(self.get_type(), *not_expected_data_id)
-                    return False
-            self.job_info['status'] = JobStatus.Active
-            return True
+            expected_data_ids, not_expected_data_ids = self.list_dependencies(run_date)
+            existing_data_ids = self.job_data.files_exist(expected_data_ids + not_expected_data_ids) if expected_data_ids or not_expected_data_ids else set()
+            return self.match_dependencies(expected_data_ids, not_expected_data_ids, existing_data_ids)
         return False
 
+    def list_dependencies(self, run_date: datetime) -> tuple[list[tuple[str, str]], list[tuple[str, str]]]:
+        return [ tuple(data_id) for data_id in self.list_expected(run_date) ], [ tuple(data_id) for data_id in self.list_not_expected(run_date) ]
+
+    def match_dependencies(self, expected_data_ids: list, not_expected_data_ids: list, existing_data_ids: set) -> bool:
+        # Check required data
+        for expected_data_id in expected_data_ids:
+            if expected_data_id not in existing_data_ids:
+                self.message = 'Job {0} expects data {1}/{2} but it does not exist.'.format(self.get_type(), *expected_data_id)
+                return False
+        # Check unexpected data
+        for not_expected_data_id in not_expected_data_ids:
+            if not_expected_data_id in existing_data_ids:
+                self.message = 'Job {0} does not expect data {1}/{2} but it exists.'.format(self.get_type(), *not_expected_data_id)
+                return False
+        self.job_info['status'] = JobStatus.Active
+        return True
+
     def load_items(self, last_processed: str) -> tuple[bool, list]:
         '''
         Optional for subclass to override. It is used to populate the list to loop through.
@@ -60,6 +229,38 @@ class BaseJob(object):
         '''
         return True, []
 
+    def load_pages(self, last_processed: str) -> Iterator[tuple[bool, list]]:
+        '''
+        Optional for subclass to override to load items lazily, e.g. one query page at a time. Yield tuples in the same form as load_items,
+        the all-loaded flag of the last page processed decides whether the job is completed. The next page is only pulled after the items of
+        the previous one are handled, unless prefetch_pages is set, then up to that many pages are pulled ahead on a background thread and it
+        must not depend on job_states. The states are checkpointed before each further page is processed, and it stops early on batch_size
+        or max_run_seconds.
+        - The default yields the page from load_items. If drain_pages is set, it keeps calling load_items after the last item of each page
+          until all is loaded. The items may be a sequence or any iterable, see track_page.
+        '''
+        drain_pages = self.job_inputs.get('drain_pages', False)
+        all_loaded, work_items = self.load_items(last_processed)
+        while True:
+            if drain_pages:
+                work_items = self.track_page(work_items)
+            yield all_loaded, work_items
+            last_item = get_last_item(work_items)
+            if all_loaded or not drain_pages or last_item is _NO_ITEM:
+                break
+            all_loaded, work_items = self.load_items(str(last_item))
+
+    def track_page(self, work_items):
+        '''
+        The last item of a sequence is known up front, an iterator page is wrapped to record it as it is consumed. With prefetch_pages,
+        the next page is loaded before the current one is consumed, so an iterator page is read into a list on the prefetch thread instead.
+        '''
+        if isinstance(work_items, Sequence):
+            return work_items
+        if self.job_inputs.get('prefetch_pages', 0) > 0:
+            return list(work_items)
+        return TrackedPage(work_items)
+
     def process_item(self, work_item) -> bool:
         '''
         Optional for subclass to override. Logic to process one item in the list. Return True if the item is processed successfully, false if it is skipped.
@@ -68,6 +269,19 @@ class BaseJob(object):
         '''
         raise NotImplementedError('process_one is not implemented.')
 
+    def process_batch(self, work_items: list) -> list[bool]:
+        '''
+        Optional for subclass to override to handle a chunk of items at once, e.g. vectorized scoring or one bulk insert. Return a list of
+        flags in the order of the items, True if the item is processed successfully, false if it is skipped.
+         - If it is overridden, it is called in place of process_item with chunks of up to process_chunk_size items.
+         - If the chunk could not be processed and need to be retried later, raise an exception to exit current iteration. No item in
+           the chunk is counted as handled in that case.
+        '''
+        return [ self.process_item(work_item) for work_item in work_items ]
+
+    def overrides_process_batch(self) -> bool:
+        return 'process_batch' in self.__dict__ or type(self).process_batch is not BaseJob.process_batch
+
     def post_loop(self, run_date: datetime):
         '''
         Optional for subclass to override. It is for post-loop handling, e.g. saving final result to blob.
@@ -79,36 +293,52 @@ class BaseJob(object):
             self.start_time = datetime.now(timezone.utc)
             return self.internal_run()
         except Exception as err:
-            self.job_info['status'] = JobStatus.Suspended
-            self.message = 'Job failed with error: ' + str(err)[0:200]
-            return self.save_results(False)
+            return self.handle_error(err)
+
+    def handle_error(self, err: Exception):
+        self.suspend_on_error(err)
+        return self.save_results(False)
+
+    def suspend_on_error(self, err: Exception):
+        self.job_info['status'] = JobStatus.Suspended
+        self.message = 'Job failed with error: ' + str(err)[0:200]
 
     def internal_run(self):
         if not self.check_dependencies(self.job_inputs['run_date']):
             return True # If job is skipped due to dependencies or in not runnable status, return as success.
 
-        all_loaded, work_items = self.load_items(self.job_states['last_processed'])
-        
-        item_count = 0
-        for work_item in work_items:
-            if self.process_item(work_item):
-                self.job_states['processed'] += 1
-            else:
-                self.job_states['skipped'] += 1
-
-            item_count += 1
-            self.job_states['last_processed'] = str(work_item)
-
-            if item_count >= self.job_inputs['batch_size']:
-                self.message = 'Job {0} is suspended for reaching batch size {1} after handling {2} with ending item {3}.'.format(
-                    self.get_type(), self.job_inputs['batch_size'], item_count, self.job_states['last_processed'])
-                break
+        pages = self.load_pages(self.job_states['last_processed'])
+        if self.job_inputs.get('prefetch_pages', 0) > 0:
+            pages = prefetch_pages(pages, self.job_inputs['prefetch_pages'])
+        loop_start = time.monotonic()
+        all_loaded, item_count = self.process_pages(pages)
+        self.record_item_seconds(time.monotonic() - loop_start, item_count)
+        self.post_loop(self.job_inputs['run_date'])
+        self.complete_loop(all_loaded, item_count)
+        return self.save_results(True)
 
-            if self.job_inputs['process_interval'] > 0:
-                time.sleep(self.job_inputs['process_interval'])
+    def process_pages(self, pages: Iterator[tuple[bool, list]]) -> tuple[bool, int]:
+        all_loaded, item_count = True, 0
+        try:
+            for page_number, (all_loaded, work_items) in enumerate(pages):
+                if page_number > 0:
+                    self.checkpoint_states()
+                item_count = self.process_page(work_items, item_count)
+                if self.message: # stopped by batch size or time budget
+                    break
+        finally:
+            if hasattr(pages, 'close'):
+                pages.close()
+        return all_loaded, item_count
 
-        self.post_loop(self.job_inputs['run_date'])
+    def process_page(self, work_items, item_count: int = 0) -> int:
+        if self.overrides_process_batch():
+            return self.process_batches(work_items, item_count)
+        elif self.job_inputs.get('max_workers', 1) > 1:
+            return self.process_items_concurrently(work_items, item_count)
+        return self.process_items(work_items, item_count)
 
+    def complete_loop(self, all_loaded: bool, item_count: int):
         if not self.message: # if no message, we infer that all items in the list are handled.
             if all_loaded:
                 self.job_info['status'] = JobStatus.Completed
@@ -116,13 +346,129 @@ class BaseJob(object):
             else:
                 self.job_info['status'] = JobStatus.Suspended
                 self.message = 'Job {0} is suspended for more data to load.'.format(self.get_type())
-
-        return self.save_results(True)
     
-    def save_results(self, success: bool) -> tuple[bool, str]:
+    def complete_item(self, work_item, processed: bool):
+        self.count_item(work_item, processed)
+        if self.is_checkpoint_due():
+            self.checkpoint_states()
+
+    def count_item(self, work_item, processed: bool):
+        if processed:
+            self.job_states['processed'] += 1
+        else:
+            self.job_states['skipped'] += 1
+        self.job_states['last_processed'] = str(work_item)
+        self.items_since_checkpoint += 1
+
+    def is_checkpoint_due(self) -> bool:
+        checkpoint_items = self.job_inputs.get('checkpoint_items', 0)
+        if checkpoint_items > 0 and self.items_since_checkpoint >= checkpoint_items:
+            return True
+        checkpoint_seconds = self.job_inputs.get('checkpoint_seconds', 0)
+        return checkpoint_seconds > 0 and time.monotonic() - self.checkpoint_time >= checkpoint_seconds
+
+    def check_batch_size(self, item_count: int) -> bool:
+        if item_count >= self.batch_size:
+            self.message = 'Job {0} is suspended for reaching batch size {1} after handling {2} with ending item {3}.'.format(
+                self.get_type(), self.batch_size, item_count, self.job_states['last_processed'])
+            return True
+        return False
+
+    def check_time_budget(self, item_count: int) -> bool:
+        max_run_seconds = self.job_inputs.get('max_run_seconds', 0)
+        if max_run_seconds > 0 and (datetime.now(timezone.utc) - self.start_time).total_seconds() >= max_run_seconds:
+            self.message = 'Job {0} is suspended for reaching time budget of {1} seconds after handling {2} with ending item {3}.'.format(
+                self.get_type(), max_run_seconds, item_count, self.job_states['last_processed'])
+            return True
+        return False
+
+    def check_limits(self, item_count: int) -> bool:
+        return self.check_batch_size(item_count) or self.check_time_budget(item_count)
+
+    def process_items(self, work_items, item_count: int = 0) -> int:
+        for work_item in work_items:
+            self.complete_item(work_item, self.call_with_limit(self.process_item, work_item))
+            item_count += 1
+
+            if self.check_limits(item_count):
+                break
+        return item_count
+
+    def process_batches(self, work_items, item_count: int = 0) -> int:
+        chunk_size = self.job_inputs.get('process_chunk_size', DEFAULT_CHUNK_SIZE)
+        item_iter = iter(work_items)
+        while True:
+            chunk = list(islice(item_iter, min(chunk_size, self.batch_size - item_count)))
+            if not chunk:
+                break
+
+            results = self.call_with_limit(self.process_batch, chunk, len(chunk))
+            if len(results) != len(chunk):
+                raise ValueError('process_batch returned {0} results for {1} items.'.format(len(results), len(chunk)))
+            for work_item, processed in zip(chunk, results):
+                self.complete_item(work_item, processed)
+            item_count += len(chunk)
+
+            if self.check_limits(item_count):
+                break
+        return item_count
+
+    def process_items_concurrently(self, work_items, item_count: int = 0) -> int:
+        '''
+        Process items on a thread pool of max_workers, process_item must be thread-safe and idempotent for this.
+        Items are submitted in order with at most twice max_workers in flight, and completed in order, so last_processed only
+        advances over contiguous finished items. If an item fails, the items after it are not counted and will be redone on resume.
+        '''
+        max_workers = self.job_inputs['max_workers']
+        item_iter = iter(work_items)
+        in_flight = deque()
+        all_submitted = False
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                while True:
+                    while not all_submitted and len(in_flight) < 2 * max_workers and item_count + len(in_flight) < self.batch_size:
+                        work_item = next(item_iter, _NO_ITEM)
+                        if work_item is _NO_ITEM:
+                            all_submitted = True
+                            break
+                        in_flight.append((work_item, executor.submit(self.call_with_limit, self.process_item, work_item)))
+                    if not in_flight:
+                        break
+                    work_item, future = in_flight.popleft()
+                    self.complete_item(work_item, future.result())
+                    item_count += 1
+                    if self.check_limits(item_count):
+                        break
+            finally:
+                for _, future in in_flight:
+                    future.cancel()
+        return item_count
+
+    def checkpoint_states(self):
+        '''
+        Save the states in the middle of a run, so a crash only redoes the items since the last checkpoint. It is called before each
+        further page and, if checkpoint_items or checkpoint_seconds is set, after that many items or seconds. Only the states are merged
+        into a stored info. A new job is only stored by save_results, so unless info_saved is set for an info read from the table, as
+        JobRunner does, the first checkpoint writes the whole info.
+        '''
+        self.stamp_states()
+        if self.info_saved:
+            self.job_data.checkpoint_states(self.job_info)
+        else:
+            self.job_data.upsert_info(self.job_info)
+            self.info_saved = True
+        self.reset_checkpoint()
+
+    def stamp_states(self):
         # self.job_info['inputs'] = pickle.dumps(self.job_inputs) # inputs should not change
         self.job_info['states'] = pickle.dumps(self.job_states)
         self.job_info['update_time'] = datetime.now(timezone.utc)
 
+    def reset_checkpoint(self):
+        self.items_since_checkpoint = 0
+        self.checkpoint_time = time.monotonic()
+
+    def save_results(self, success: bool) -> tuple[bool, str]:
+        self.stamp_states()
         self.job_data.complete_run(success, self.job_info, self.message, self.start_time)
         return success
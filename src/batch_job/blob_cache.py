@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import uuid
+
+from batch_job import CACHE_DIR
+from batch_job.blob_store import BlobStore, DownloadResult
+
+
+DEFAULT_CACHE_MAX_BYTES = 10 * 1024 * 1024 * 1024
+
+
+def get_meta_path(file_path: str) -> str:
+    return file_path + '.meta'
+
+
+def get_unique_path(path: str) -> str:
+    return '{0}.{1}'.format(path, uuid.uuid4().hex)
+
+
+def touch(file_path: str) -> bool:
+    # The modification time is the last use for evicting least recently used files.
+    try:
+        os.utime(file_path)
+        return True
+    except OSError:
+        return False
+
+
+def remove_file(file_path: str):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+class LocalBlobCache(object):
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        '''
+        An on-disk cache of blobs at <cache_dir>/<container>/<blob>.tmp, the same layout as JobData temp files but in its own directory,
+        as eviction removes any .tmp file and uploads rewrite their temp file in place. The ETag, size and inode of each file are kept
+        in a .meta file next to it, so a cached file is revalidated with a conditional GET on each use and only downloaded again if the
+        blob changed. Files are downloaded to a unique name and renamed into place, so processes sharing the directory never read a
+        partial file, and metadata not matching the current file is ignored. After each download, the least recently used files are
+        evicted until the cached files take at most max_bytes. hits and misses count the uses served from the cache and the downloads.
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get_file_path(self, container_name: str, blob_name: str) -> str:
+        file_path = '{0}/{1}/{2}.tmp'.format(self.cache_dir, container_name, blob_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        return file_path
+
+    def get(self, blob_store: BlobStore, container_name: str, blob_name: str) -> str:
+        '''
+        Return the path of an up-to-date copy of the blob, or None if the blob does not exist.
+        '''
+        file_path = self.get_file_path(container_name, blob_name)
+        meta = self.read_meta(file_path)
+        download_path = get_unique_path(file_path)
+        result = blob_store.download(container_name, blob_name, download_path, if_none_match=meta['etag'] if meta else None)
+        if result.status == DownloadResult.NotModified:
+            if touch(file_path):
+                self.hits += 1
+                return file_path
+            # Evicted by another process since the metadata was read
+            result = blob_store.download(container_name, blob_name, download_path)
+        if not result:
+            self.remove(container_name, blob_name)
+            return None
+        self.misses += 1
+        os.replace(download_path, file_path)
+        self.write_meta(file_path, result.etag)
+        self.evict(file_path)
+        return file_path
+
+    def record(self, container_name: str, blob_name: str, etag: str, uploaded_path: str):
+        '''
+        Keep the file just uploaded as the cached copy of the blob with the given ETag. A file uploaded from outside the cache is copied
+        into place first, so an older copy at the cache path never gets the new ETag.
+        '''
+        if not etag or not os.path.exists(uploaded_path):
+            return
+        file_path = self.get_file_path(container_name, blob_name)
+        if not os.path.exists(file_path) or not os.path.samefile(uploaded_path, file_path):
+            copy_path = get_unique_path(file_path)
+            shutil.copyfile(uploaded_path, copy_path)
+            os.replace(copy_path, file_path)
+        self.write_meta(file_path, etag)
+        self.evict(file_path)
+
+    def remove(self, container_name: str, blob_name: str):
+        file_path = self.get_file_path(container_name, blob_name)
+        remove_file(file_path)
+        remove_file(get_meta_path(file_path))
+
+    def read_meta(self, file_path: str) -> dict:
+        '''
+        Return the metadata of the file, or None if it is missing or written for an earlier file at the same path.
+        '''
+        try:
+            with open(get_meta_path(file_path), 'r') as f:
+                meta = json.load(f)
+            stat = os.stat(file_path)
+            if (meta['ino'], meta['size']) == (stat.st_ino, stat.st_size):
+                return meta
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def write_meta(self, file_path: str, etag: str):
+        stat = os.stat(file_path)
+        meta_path = get_meta_path(file_path)
+        temp_path = get_unique_path(meta_path)
+        with open(temp_path, 'w') as f:
+            json.dump({ 'etag': etag, 'size': stat.st_size, 'ino': stat.st_ino }, f)
+        os.replace(temp_path, meta_path)
+
+    def evict(self, keep_path: str = None) -> int:
+        '''
+        Remove the least recently used files until the total size is at most max_bytes, keep_path is never removed.
+        Return the number of bytes freed.
+        '''
+        files = []
+        for dir_path, _, file_names in os.walk(self.cache_dir):
+            for file_name in file_names:
+                if file_name.endswith('.tmp'):
+                    file_path = os.path.join(dir_path, file_name)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue # removed by another process
+                    files.append((stat.st_mtime, stat.st_size, file_path))
+        total_bytes = sum(size for _, size, _ in files)
+        freed_bytes = 0
+        for _, size, file_path in sorted(files):
+            if total_bytes - freed_bytes <= self.max_bytes:
+                break
+            if keep_path and os.path.normpath(file_path) == os.path.normpath(keep_path):
+                continue
+            remove_file(file_path)
+            remove_file(get_meta_path(file_path))
+            freed_bytes += size
+        return freed_bytes
@@ -1,62 +1,451 @@
-from azure.core.exceptions import HttpResponseError
-from azure.storage.blob import BlobServiceClient
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, ContainerClient, StorageErrorCode, StorageStreamDownloader
+from concurrent.futures import ThreadPoolExecutor
+import io
 import os
+import threading
+import uuid
+
+from batch_job import CONNECTION_POOL_SIZE
+from batch_job.transport import create_transport
+
+
+# Blobs up to DEFAULT_SINGLE_GET_SIZE are downloaded with one request, larger ones in ranges of DEFAULT_CHUNK_GET_SIZE with
+# up to DEFAULT_MAX_CONCURRENCY requests in parallel.
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_SINGLE_GET_SIZE = 32 * 1024 * 1024
+DEFAULT_CHUNK_GET_SIZE = 4 * 1024 * 1024
+# Files up to DEFAULT_SINGLE_PUT_SIZE are uploaded with one request, larger ones are staged in blocks of DEFAULT_BLOCK_SIZE
+# with up to DEFAULT_MAX_CONCURRENCY requests in parallel and committed at the end.
+DEFAULT_SINGLE_PUT_SIZE = 64 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# The maximum number of blobs deleted with one batch request.
+MAX_DELETE_BATCH_SIZE = 256
+
+# The blobs of a container are checked by listing their common prefix if there are at least this many, otherwise one request per blob.
+PREFIX_LISTING_MIN_BLOBS = 10
+# A listing stops after this many names per blob checked, e.g. when the prefix also holds many other blobs such as part files, and
+# the blobs it did not reach are checked one by one.
+MAX_LISTED_PER_BLOB = 100
+
+
+def is_container_not_found(err: HttpResponseError) -> bool:
+    return getattr(err, 'error_code', None) == StorageErrorCode.container_not_found
+
+
+def group_blob_ids(blob_ids) -> dict[str, set[str]]:
+    groups = {}
+    for container_name, blob_name in blob_ids:
+        groups.setdefault(container_name, set()).add(blob_name)
+    return groups
+
+
+def get_listing_prefix(blob_names: set[str]) -> str:
+    '''
+    The common prefix to list the blobs with, or None if they should be checked one by one.
+    '''
+    prefix = os.path.commonprefix(list(blob_names))
+    if len(blob_names) >= PREFIX_LISTING_MIN_BLOBS and prefix:
+        return prefix
+
+
+def get_unlisted(blob_names: set[str], next_listed: str) -> set[str]:
+    '''
+    The names a listing stopped before reaching next_listed has not ruled out yet.
+    '''
+    return { blob_name for blob_name in blob_names if blob_name >= next_listed }
+
+
+class UploadResult(object):
+    Created = 'Created'
+    AlreadyExists = 'AlreadyExists'
+    FileNotFound = 'FileNotFound'
+
+    def __init__(self, status: str, etag: str = None):
+        '''
+        The outcome of an upload, it is truthy only if the blob was created so it can be used as the former bool result.
+        '''
+        self.status = status
+        self.etag = etag
+
+    def __bool__(self):
+        return self.status == UploadResult.Created
+
+    def __repr__(self):
+        return 'UploadResult({0})'.format(self.status)
+
+
+class DownloadResult(object):
+    Downloaded = 'Downloaded'
+    NotModified = 'NotModified'
+    NotFound = 'NotFound'
+
+    def __init__(self, status: str, etag: str = None, size: int = None):
+        '''
+        The outcome of a download, it is truthy only if the file was written so it can be used as the former bool result.
+        '''
+        self.status = status
+        self.etag = etag
+        self.size = size
+
+    def __bool__(self):
+        return self.status == DownloadResult.Downloaded
+
+    def __repr__(self):
+        return 'DownloadResult({0})'.format(self.status)
+
+
+def get_download_conditions(if_none_match: str) -> dict:
+    '''
+    The download_blob arguments for a conditional GET, the service answers 304 Not Modified if the ETag still matches.
+    '''
+    return { 'etag': if_none_match, 'match_condition': MatchConditions.IfModified } if if_none_match else {}
+
+
+class CleanUpResult(object):
+    def __init__(self):
+        '''
+        The outcome of clean_up: the number of blobs deleted, their total size, the number that failed to delete, and whether
+        it stopped at max_deletes so more blobs may be left to clean up.
+        '''
+        self.deleted = 0
+        self.bytes_freed = 0
+        self.failed = 0
+        self.stopped_early = False
+
+    def count_batch(self, batch: list[tuple[str, int]], status_codes):
+        for (_, size), status_code in zip(batch, status_codes):
+            if status_code == 202:
+                self.deleted += 1
+                self.bytes_freed += size or 0
+            elif status_code != 404: # a blob deleted by others is not a failure
+                self.failed += 1
+
+    def __repr__(self):
+        return 'CleanUpResult(deleted={0}, bytes_freed={1}, failed={2}, stopped_early={3})'.format(
+            self.deleted, self.bytes_freed, self.failed, self.stopped_early)
+
+
+def get_partial_path(file_path: str) -> str:
+    '''
+    Downloads are written to this path and renamed when complete, so a failed download never leaves a truncated file at file_path.
+    The name is unique, concurrent downloads to the same file_path each write their own partial file.
+    '''
+    return '{0}.{1}.partial'.format(file_path, uuid.uuid4().hex)
+
+
+def remove_partial(partial_path: str):
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+
+
+def is_seekable(stream) -> bool:
+    return callable(getattr(stream, 'seekable', None)) and stream.seekable()
+
+
+class BufferReader(io.RawIOBase):
+    def __init__(self, data):
+        '''
+        A read-only stream over a bytearray or a memoryview, which the SDK would otherwise iterate as ints since it only wraps bytes.
+        The SDK sends bytes, so each read copies the range asked for: the whole buffer for a single put, one block at a time for a
+        staged upload.
+        '''
+        self._view = memoryview(data).cast('B')
+        self._position = 0
+
+    def __len__(self):
+        return len(self._view)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = { io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view) }[whence]
+        self._position = max(start + offset, 0)
+        return self._position
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(self._position + size, len(self._view))
+        chunk = self._view[self._position:end].tobytes()
+        self._position = max(end, self._position)
+        return chunk
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
 
 
 class BlobStore:
-    def __init__(self, connection_string):
+    def __init__(self, connection_string, pool_size=CONNECTION_POOL_SIZE, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 max_single_get_size=DEFAULT_SINGLE_GET_SIZE, max_chunk_get_size=DEFAULT_CHUNK_GET_SIZE,
+                 max_single_put_size=DEFAULT_SINGLE_PUT_SIZE, max_block_size=DEFAULT_BLOCK_SIZE):
+        '''
+        One service client is created on first use and kept open until close() is called. Container clients are memoized
+        and containers known to exist are remembered, so only write paths pay for creating a missing container.
+        Downloads are streamed to the file, a blob larger than max_single_get_size is read in ranges of max_chunk_get_size with up to
+        max_concurrency parallel requests, so about max_concurrency * max_chunk_get_size bytes are held in memory. Likewise a file larger
+        than max_single_put_size is uploaded in blocks of max_block_size.
+        '''
         self._connection_string = connection_string
+        self._pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.max_single_get_size = max_single_get_size
+        self.max_chunk_get_size = max_chunk_get_size
+        self.max_single_put_size = max_single_put_size
+        self.max_block_size = max_block_size
+        self._service_client = None
+        self._containers = {}
+        self._existing_containers = set()
+        self._lock = threading.Lock()
 
-    def create_blob_client(self, container_name, blob_name):
-        blob_service_client = BlobServiceClient.from_connection_string(self._connection_string)
+    def __enter__(self):
+        return self
 
-        container = blob_service_client.get_container_client(container_name)
-        if not container.exists():
-            container.create_container()
+    def __exit__(self, *args):
+        self.close()
 
-        return container.get_blob_client(blob_name)
+    @property
+    def service_client(self) -> BlobServiceClient:
+        with self._lock:
+            if self._service_client is None:
+                self._service_client = BlobServiceClient.from_connection_string(self._connection_string, transport=create_transport(self._pool_size),
+                                                                                max_single_get_size=self.max_single_get_size,
+                                                                                max_chunk_get_size=self.max_chunk_get_size,
+                                                                                max_single_put_size=self.max_single_put_size,
+                                                                                max_block_size=self.max_block_size)
+            return self._service_client
 
-    def upload(self, container_name, blob_name, file_path) -> bool:
-        blob_client = self.create_blob_client(container_name, blob_name)
-        if os.path.exists(file_path) and not blob_client.exists():
-            with open(file_path, "rb") as data:
-                blob_client.upload_blob(data, blob_type="BlockBlob")
-            return True
-        return False
+    def close(self):
+        with self._lock:
+            self._containers = {}
+            self._existing_containers = set()
+            if self._service_client is not None:
+                self._service_client.close()
+                self._service_client = None
+
+    def get_container_client(self, container_name, create_if_missing=False) -> ContainerClient:
+        container = self._containers.get(container_name)
+        if container is None:
+            container = self.service_client.get_container_client(container_name)
+            with self._lock:
+                container = self._containers.setdefault(container_name, container)
+        if create_if_missing and container_name not in self._existing_containers:
+            try:
+                container.create_container()
+            except ResourceExistsError:
+                pass
+            self._existing_containers.add(container_name)
+        return container
+
+    def forget_container(self, container_name):
+        '''
+        Invalidate the container existence cache, e.g. after the service reports ContainerNotFound.
+        '''
+        self._existing_containers.discard(container_name)
+
+    def create_blob_client(self, container_name, blob_name, create_container=True):
+        return self.get_container_client(container_name, create_container).get_blob_client(blob_name)
+
+    def upload(self, container_name, blob_name, file_path, max_concurrency=None) -> UploadResult:
+        '''
+        Upload a file unless the blob exists. It is enforced by the service with an If-None-Match: * condition on the upload
+        (or on the block list commit for a staged upload), instead of checking the blob first.
+        '''
+        if not os.path.exists(file_path):
+            return UploadResult(UploadResult.FileNotFound)
+        with open(file_path, "rb") as data:
+            return self.upload_stream(container_name, blob_name, data, max_concurrency=max_concurrency)
+
+    def upload_bytes(self, container_name, blob_name, data, max_concurrency=None) -> UploadResult:
+        '''
+        Upload bytes, a bytearray or a memoryview unless the blob exists, without a temp file. bytes are handed to the SDK as they are,
+        other buffers are read through a BufferReader.
+        '''
+        if not isinstance(data, bytes):
+            data = BufferReader(data)
+        return self.upload_stream(container_name, blob_name, data, len(data), max_concurrency)
 
-    def download(self, container_name, blob_name, file_path) -> bool:
+    def upload_stream(self, container_name, blob_name, stream, length: int = None, max_concurrency=None) -> UploadResult:
+        '''
+        Upload a readable file-like object or an iterable of bytes chunks, e.g. a generator, unless the blob exists. The SDK reads it
+        as the request is sent, the length is found from the stream when it is not given. Only bytes or a seekable stream can be read again
+        after the container had to be recreated, otherwise the ContainerNotFound error is raised.
+        '''
+        start = stream.tell() if is_seekable(stream) else None
+        rewindable = start is not None or isinstance(stream, bytes)
+        try:
+            try:
+                response = self.upload_once(container_name, blob_name, stream, length, max_concurrency)
+            except ResourceNotFoundError as err:
+                # The container was deleted since it was cached, recreate it and try once more.
+                if not is_container_not_found(err):
+                    raise
+                self.forget_container(container_name)
+                if not rewindable:
+                    raise
+                if start is not None:
+                    stream.seek(start)
+                response = self.upload_once(container_name, blob_name, stream, length, max_concurrency)
+        except ResourceExistsError:
+            return UploadResult(UploadResult.AlreadyExists)
+        return UploadResult(UploadResult.Created, (response or {}).get('etag'))
+
+    def upload_once(self, container_name, blob_name, data, length: int = None, max_concurrency=None) -> dict:
         blob_client = self.create_blob_client(container_name, blob_name)
-        if blob_client.exists():
-            with open(file_path, "wb") as data:
-                download_stream = blob_client.download_blob()
-                data.write(download_stream.readall())
-            return True
-        return False
-    
+        return blob_client.upload_blob(data, length=length, blob_type="BlockBlob", overwrite=False,
+                                       max_concurrency=max_concurrency or self.max_concurrency)
+
+    def download(self, container_name, blob_name, file_path, max_concurrency=None, if_none_match: str = None) -> DownloadResult:
+        '''
+        Download a blob to file_path. If if_none_match is the ETag of a copy already downloaded, nothing is written unless the blob changed.
+        '''
+        blob_client = self.create_blob_client(container_name, blob_name, False)
+        try:
+            download_stream = blob_client.download_blob(max_concurrency=max_concurrency or self.max_concurrency, **get_download_conditions(if_none_match))
+        except ResourceNotFoundError as err:
+            if is_container_not_found(err):
+                self.forget_container(container_name)
+            return DownloadResult(DownloadResult.NotFound)
+        except HttpResponseError as err:
+            # The service answers a matching If-None-Match with 304, which the SDK raises as ResourceModifiedError or HttpResponseError.
+            if err.status_code == 304:
+                return DownloadResult(DownloadResult.NotModified, if_none_match)
+            raise
+        partial_path = get_partial_path(file_path)
+        try:
+            with open(partial_path, "wb") as data:
+                download_stream.readinto(data)
+            os.replace(partial_path, file_path)
+        finally:
+            remove_partial(partial_path)
+        return DownloadResult(DownloadResult.Downloaded, download_stream.properties.etag, download_stream.properties.size)
+
+    def download_bytes(self, container_name, blob_name, max_concurrency=None) -> bytes:
+        '''
+        Return the content of a blob, or None if it does not exist.
+        '''
+        download_stream = self.open_read_stream(container_name, blob_name, max_concurrency)
+        return download_stream.readall() if download_stream is not None else None
+
+    def open_read_stream(self, container_name, blob_name, max_concurrency=None) -> StorageStreamDownloader:
+        '''
+        Return a stream of the blob content read as it is consumed, with read(size), chunks() or readinto(stream), or None
+        if the blob does not exist. Only max_single_get_size bytes are fetched before it is returned.
+        '''
+        blob_client = self.create_blob_client(container_name, blob_name, False)
+        try:
+            return blob_client.download_blob(max_concurrency=max_concurrency or self.max_concurrency)
+        except ResourceNotFoundError as err:
+            if is_container_not_found(err):
+                self.forget_container(container_name)
+            return None
+
     def exists(self, container_name, blob_name) -> bool:
-        blob_client = self.create_blob_client(container_name, blob_name)
+        blob_client = self.create_blob_client(container_name, blob_name, False)
         return blob_client.exists()
 
+    def exists_many(self, blob_ids) -> set[tuple[str, str]]:
+        '''
+        Check (container_name, blob_name) tuples at once, return the set of those that exist. The blobs of a container are checked by one
+        listing of their common prefix if there are many of them, the rest, and those the listing did not reach, with concurrent requests
+        on the connection pool.
+        '''
+        existing = set()
+        single_checks = []
+        for container_name, blob_names in group_blob_ids(blob_ids).items():
+            prefix = get_listing_prefix(blob_names)
+            if prefix:
+                found, unchecked = self.list_existing(container_name, prefix, blob_names)
+                existing.update((container_name, blob_name) for blob_name in found)
+                single_checks.extend((container_name, blob_name) for blob_name in unchecked)
+            else:
+                single_checks.extend((container_name, blob_name) for blob_name in blob_names)
+        if single_checks:
+            with ThreadPoolExecutor(max_workers=min(self._pool_size, len(single_checks))) as executor:
+                found = executor.map(lambda blob_id: self.exists(*blob_id), single_checks)
+                existing.update(blob_id for blob_id, exists in zip(single_checks, found) if exists)
+        return existing
+
+    def list_existing(self, container_name, prefix: str, blob_names: set[str]) -> tuple[set[str], set[str]]:
+        '''
+        Return the names in blob_names found by listing the prefix, and those not reached within MAX_LISTED_PER_BLOB names per blob.
+        Blobs are listed in name order, so it stops after the last name and the names before the last one listed are known to be missing.
+        '''
+        last_name = max(blob_names)
+        max_listed = len(blob_names) * MAX_LISTED_PER_BLOB
+        found = set()
+        try:
+            for listed, blob in enumerate(self.get_container_client(container_name).list_blob_names(name_starts_with=prefix)):
+                if blob > last_name:
+                    break
+                if listed >= max_listed:
+                    return found, get_unlisted(blob_names, blob)
+                if blob in blob_names:
+                    found.add(blob)
+        except ResourceNotFoundError as err:
+            if not is_container_not_found(err):
+                raise
+            self.forget_container(container_name)
+        return found, set()
+
     def delete(self, container_name, blob_name) -> bool:
-        blob_client = self.create_blob_client(container_name, blob_name)
-        if blob_client.exists():
+        blob_client = self.create_blob_client(container_name, blob_name, False)
+        try:
             blob_client.delete_blob()
+            return True
+        except ResourceNotFoundError as err:
+            if is_container_not_found(err):
+                self.forget_container(container_name)
+            return False
+
+    def clean_up(self, container_name, least_blob_name: str, prefix: str = None, max_deletes: int = None) -> CleanUpResult:
+        '''
+        Delete the blobs named before least_blob_name, only those starting with prefix if it is given, and at most max_deletes of them.
+        The listing is fetched page by page in name order and stops at least_blob_name, the blobs are deleted with batch requests of
+        up to 256 blobs, so neither the listing nor the deleted names are held in memory.
+        '''
+        container = self.get_container_client(container_name)
+        result = CleanUpResult()
 
-    def clean_up(self, container_name, least_blob_name: str) -> list[str]:
-        blob_service_client = BlobServiceClient.from_connection_string(self._connection_string)
-        container = blob_service_client.get_container_client(container_name)
-        deleted = []
-        if container.exists():
-            for blob in container.list_blob_names():
-                if blob < least_blob_name:
-                    container.delete_blob(blob)
-                    deleted.append(blob)
-        return deleted
+        def delete_batch(batch):
+            responses = container.delete_blobs(*[ name for name, _ in batch ], raise_on_any_failure=False)
+            result.count_batch(batch, [ response.status_code for response in responses ])
+
+        batch = []
+        queued = 0
+        try:
+            for blob in container.list_blobs(name_starts_with=prefix):
+                if blob.name >= least_blob_name:
+                    break
+                if max_deletes is not None and queued >= max_deletes:
+                    result.stopped_early = True
+                    break
+                batch.append((blob.name, blob.size))
+                queued += 1
+                if len(batch) == MAX_DELETE_BATCH_SIZE:
+                    delete_batch(batch)
+                    batch = []
+            if batch:
+                delete_batch(batch)
+        except ResourceNotFoundError as err:
+            if not is_container_not_found(err):
+                raise
+            self.forget_container(container_name)
+        return result
 
     def lease_blob(self, container_name, blob_name, lease_duration=15):
-        blob_client = self.create_blob_client(container_name, blob_name)
-        if blob_client.exists():
-            try:
-                return blob_client.acquire_lease(lease_duration=lease_duration)
-            except HttpResponseError:
-                pass
+        blob_client = self.create_blob_client(container_name, blob_name, False)
+        try:
+            return blob_client.acquire_lease(lease_duration=lease_duration)
+        except HttpResponseError:
+            # Covers missing blob/container (not found) and an existing lease held by others (conflict).
+            pass
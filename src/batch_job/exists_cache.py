@@ -0,0 +1,76 @@
+import threading
+import time
+
+
+class ExistsCache(object):
+    def __init__(self, positive_ttl: float = 3600, negative_ttl: float = 60):
+        '''
+        Cache blob existence by (container_name, blob_name). A blob found to exist is kept for positive_ttl seconds, a missing one only for
+        negative_ttl seconds, so a pending job polling for its inputs still sees them soon after they are written by others. It is thread-safe
+        and can be shared by several JobData objects. hits and misses count the lookups.
+        Each invalidate bumps the generation of the blob. A check reads the generation before its request and passes it to put, so a
+        result read before a write that finished meanwhile is dropped instead of cached.
+        '''
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, blob_id: tuple[str, str]) -> bool:
+        '''
+        Return the cached result, or None if it is not cached or expired.
+        '''
+        with self._lock:
+            entry = self._entries.get(blob_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(blob_id, None)
+            self.misses += 1
+            return None
+
+    def get_generation(self, blob_id: tuple[str, str]) -> int:
+        with self._lock:
+            return self._generations.get(blob_id, 0)
+
+    def get_generations(self, blob_ids) -> dict[tuple[str, str], int]:
+        with self._lock:
+            return { blob_id: self._generations.get(blob_id, 0) for blob_id in blob_ids }
+
+    def put(self, blob_id: tuple[str, str], exists: bool, generation: int = None):
+        '''
+        Cache the result, unless the blob was invalidated since generation was read.
+        '''
+        with self._lock:
+            if generation is not None and generation != self._generations.get(blob_id, 0):
+                return
+            self._entries[blob_id] = (exists, time.monotonic() + (self.positive_ttl if exists else self.negative_ttl))
+
+    def lookup(self, blob_ids) -> tuple[set[tuple[str, str]], list[tuple[str, str]]]:
+        '''
+        Return the cached blobs that exist and the blobs that are not cached.
+        '''
+        existing, unknown = set(), []
+        for blob_id in blob_ids:
+            exists = self.get(tuple(blob_id))
+            if exists is None:
+                unknown.append(tuple(blob_id))
+            elif exists:
+                existing.add(tuple(blob_id))
+        return existing, unknown
+
+    def update(self, blob_ids, existing: set[tuple[str, str]], generations: dict[tuple[str, str], int] = None):
+        for blob_id in blob_ids:
+            self.put(blob_id, blob_id in existing, generations.get(blob_id) if generations is not None else None)
+
+    def invalidate(self, blob_id: tuple[str, str]):
+        with self._lock:
+            self._entries.pop(blob_id, None)
+            self._generations[blob_id] = self._generations.get(blob_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
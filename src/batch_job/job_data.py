@@ -1,11 +1,15 @@
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timezone
+import mmap
 import os
-from typing import Callable
+from typing import BinaryIO, Callable, Iterable, Iterator, Union
 from typing_extensions import TypedDict
 
-from batch_job import TEMP_DIR
-from batch_job.blob_store import BlobStore
-from batch_job.table_store import TableStore
+from batch_job import TEMP_DIR, CONNECTION_POOL_SIZE
+from batch_job.blob_cache import LocalBlobCache
+from batch_job.blob_store import BlobStore, UploadResult
+from batch_job.exists_cache import ExistsCache
+from batch_job.table_store import TableStore, UpdateMode, create_table_service_client
 
 
 class JobStatus:
@@ -16,9 +20,11 @@ class JobStatus:
     Failed = 'failed'        # An end state. Job has failed due to too many errors or consecutive errors.
     Expired = 'expired'      # An end state. Job has not finished before the maximum hours for it to run. Newer inputs may be available for a job at a more recent time.
 
+    EndStates = [ Completed, Failed, Expired ]
+
     @staticmethod
     def is_end_state(status):
-        return status in [ JobStatus.Completed, JobStatus.Failed, JobStatus.Expired ]
+        return status in JobStatus.EndStates
 
 
 class JobInfo(TypedDict):
@@ -30,11 +36,13 @@ class JobInfo(TypedDict):
     status: str        # current job status
     create_time: datetime
     update_time: datetime
+    consecutive_failures: int  # failed runs since the last successful run, kept by complete_run
+    total_failures: int        # all failed runs, kept by complete_run
 
 
 class JobRun(TypedDict):
     PartitionKey: str   # Reference to JobInfo RowKey
-    RowKey: str         # endTime_PartitionKey
+    RowKey: str         # endTime_PartitionKey, or invertedTicks_PartitionKey with inverted_run_keys
     is_error: bool
     message: str
     end_status: str     # the ending job status after this run
@@ -42,12 +50,135 @@ class JobRun(TypedDict):
     end_time: datetime
 
 
-class JobData(object):
-    def __init__(self, conn_str: str, temp_dir: str=TEMP_DIR):
-        self.info_store = TableStore(conn_str, "JobInfo")
-        self.run_store = TableStore(conn_str, "JobRun")
-        self.blob_store = BlobStore(conn_str)
+# Projections for the queries of the runner, to avoid loading pickled inputs/states and run messages.
+INFO_SUMMARY_COLUMNS = ['PartitionKey', 'RowKey', 'status', 'create_time', 'consecutive_failures', 'total_failures']
+RUN_FAILURE_COLUMNS = ['is_error', 'start_time']
+
+
+# Ticks are 100 nanoseconds since 0001-01-01 as DateTime.Ticks in .NET, inverted ticks make the latest run sort first.
+MAX_TICKS = 3155378975999999999
+TICKS_EPOCH = datetime(1, 1, 1, tzinfo=timezone.utc)
+# Legacy run keys start with the end time in %Y%m%d (below 22 until year 2200), while inverted ticks keys start with 22 or above
+# until year 3000, so all inverted keys sort after all legacy keys in the same partition.
+INVERTED_RUN_KEY_FLOOR = '22'
+
+
+def to_inverted_ticks(time: datetime) -> int:
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    delta = time - TICKS_EPOCH
+    return MAX_TICKS - (delta.days * 864000000000 + delta.seconds * 10000000 + delta.microseconds * 10)
+
+
+def has_failure_counters(job_info: JobInfo) -> bool:
+    # A selected property missing on the entity is returned as None.
+    return job_info.get('consecutive_failures') is not None and job_info.get('total_failures') is not None
+
+
+class BaseJobData(object):
+    '''
+    Keys, filters and records shared by JobData and AsyncJobData, without any storage access.
+    '''
+    def __init__(self, temp_dir: str=TEMP_DIR, inverted_run_keys: bool=False, exists_cache: ExistsCache=None):
         self.temp_dir = temp_dir
+        self.inverted_run_keys = inverted_run_keys
+        self.exists_cache = exists_cache
+
+    def get_partition_key(self, job_id: str) -> str:
+        id_parts = job_id.split('_')
+        assert(len(id_parts) == 4)
+        return '_'.join(id_parts[2:])
+
+    def get_active_filter(self) -> tuple[str, dict]:
+        '''
+        The filter for the infos not in an end state and its parameters.
+        '''
+        parameters = { 'end{0}'.format(i): status for i, status in enumerate(JobStatus.EndStates) }
+        return ' and '.join('status ne @{0}'.format(name) for name in parameters), parameters
+
+    def get_status_update(self, job_info: JobInfo, status: str, current_time: datetime) -> dict:
+        '''
+        Only the status and update time are merged, so job_info could be a projection from list_infos without inputs and states.
+        '''
+        job_info['status'] = status
+        job_info['update_time'] = current_time
+        return { key: job_info[key] for key in ['PartitionKey', 'RowKey', 'status', 'update_time'] }
+
+    def update_failure_counters(self, success: bool, job_info: JobInfo):
+        if success:
+            job_info['consecutive_failures'] = 0
+        else:
+            job_info['consecutive_failures'] += 1
+            job_info['total_failures'] += 1
+
+    def get_failure_counters(self, job_info: JobInfo) -> dict:
+        return { key: job_info[key] for key in ['PartitionKey', 'RowKey', 'consecutive_failures', 'total_failures'] }
+
+    def summarize_runs(self, job_runs: list[JobRun]) -> tuple[int, int]:
+        consecutive_failure_count = 0
+        for run in sorted(job_runs, key=lambda x: x['start_time'], reverse=True):
+            if run['is_error']:
+                consecutive_failure_count += 1
+            else:
+                break
+        return consecutive_failure_count, sum(1 for run in job_runs if run['is_error'])
+
+    def get_run_key(self, job_id: str, end_time: datetime) -> str:
+        if self.inverted_run_keys:
+            return '{0:019d}_{1}'.format(to_inverted_ticks(end_time), job_id)
+        return end_time.strftime('%Y%m%d%H%M%S%f') + '_' + job_id
+
+    def create_run(self, job_id: str, start_time: datetime, end_time: datetime, message: str, end_status: str, is_error: bool = False) -> JobRun:
+        return {
+            "PartitionKey": job_id,
+            "RowKey": self.get_run_key(job_id, end_time),
+            "is_error": is_error,
+            "message": message,
+            "end_status": end_status,
+            "start_time": start_time,
+            "end_time": end_time
+        }
+
+    def invalidate_exists(self, container_name: str, blob_name: str):
+        # Called after a write, a check that started before it is not cached, see ExistsCache.
+        if self.exists_cache is not None:
+            self.exists_cache.invalidate((container_name, blob_name))
+
+    def get_temp_file_path(self, container_name: str, blob_name: str) -> str:
+        dir_path = '{0}/{1}'.format(self.temp_dir, container_name)
+        os.makedirs(dir_path, exist_ok=True)
+        return dir_path + '/' + blob_name + '.tmp'
+
+
+class JobData(BaseJobData):
+    def __init__(self, conn_str: str, temp_dir: str=TEMP_DIR, pool_size: int=CONNECTION_POOL_SIZE, inverted_run_keys: bool=False,
+                 exists_cache: ExistsCache=None, blob_cache: LocalBlobCache=None):
+        '''
+        Pass an exists_cache to cache file_exists and files_exist results, it is opt-in as a cached result could be stale within its TTL.
+        Pass a blob_cache to keep downloaded files in a size-bounded cache revalidated on each download_file. Without it, an existing
+        temp file is used as is. The blob_cache directory must differ from temp_dir.
+        '''
+        if blob_cache is not None and os.path.realpath(blob_cache.cache_dir) == os.path.realpath(temp_dir):
+            raise ValueError('blob_cache can not use the temp_dir {0}, its eviction would remove files being uploaded.'.format(temp_dir))
+        # Both table stores share one service client, i.e. one connection pool, which is closed with this object.
+        self.table_service = create_table_service_client(conn_str, pool_size)
+        self.info_store = TableStore(conn_str, "JobInfo", self.table_service)
+        self.run_store = TableStore(conn_str, "JobRun", self.table_service)
+        self.blob_store = BlobStore(conn_str, pool_size)
+        self.blob_cache = blob_cache
+        super().__init__(temp_dir, inverted_run_keys, exists_cache)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.info_store.close()
+        self.run_store.close()
+        self.table_service.close()
+        self.blob_store.close()
 
     def create_if_not_exist(self):
         self.info_store.create_if_not_exist()
@@ -58,83 +189,237 @@ class JobData(object):
             return data
     
     def get_info(self, job_id: str):
-        id_parts = job_id.split('_')
-        assert(len(id_parts) == 4)
-        partition_key = '_'.join(id_parts[2:])
-        return self.info_store.get_entity(partition_key, job_id)
+        return self.info_store.get_entity(self.get_partition_key(job_id), job_id)
+
+    def info_exists(self, job_id: str) -> bool:
+        '''
+        Point read by PartitionKey and RowKey, only the RowKey is returned.
+        '''
+        return self.info_store.get_entity(self.get_partition_key(job_id), job_id, select=['RowKey']) is not None
     
-    def list_infos(self, job_name: str):
-        return self.info_store.query_entities(job_name)
+    def list_infos(self, job_name: str, select: list[str] = None, results_per_page: int = None) -> Iterator[JobInfo]:
+        return self.info_store.iter_entities(job_name, select=select, results_per_page=results_per_page)
+
+    def list_active_infos(self, job_name: str, select: list[str] = None, results_per_page: int = None) -> Iterator[JobInfo]:
+        '''
+        Same as list_infos, but the table service filters out the infos in an end state, so the cost does not grow with the job history.
+        '''
+        query_filter, parameters = self.get_active_filter()
+        return self.info_store.iter_entities(job_name, select=select, results_per_page=results_per_page,
+                                             query_filter=query_filter, parameters=parameters)
     
-    def list_runs(self, job_id: str):
-        return self.run_store.query_entities(job_id)
+    def list_runs(self, job_id: str, select: list[str] = None, results_per_page: int = None) -> Iterator[JobRun]:
+        return self.run_store.iter_entities(job_id, select=select, results_per_page=results_per_page)
+
+    def latest_runs(self, job_id: str, n: int, select: list[str] = None) -> list[JobRun]:
+        '''
+        Get the latest n runs of a job, the latest first. Runs with inverted ticks keys are read in key order with a page of n,
+        which stops after the first page. Runs with legacy keys are older than those and sorted oldest first, so they are only
+        read, with the last ones kept, when there are fewer than n inverted ones.
+        '''
+        runs = []
+        for run in self.run_store.iter_entities(job_id, INVERTED_RUN_KEY_FLOOR, select=select, results_per_page=n):
+            runs.append(run)
+            if len(runs) >= n:
+                return runs
+        legacy_runs = deque(maxlen=n - len(runs))
+        legacy_runs.extend(self.run_store.iter_entities(job_id, select=select, query_filter='RowKey lt @floor',
+                                                        parameters={ 'floor': INVERTED_RUN_KEY_FLOOR }))
+        runs.extend(reversed(legacy_runs))
+        return runs
+
+    def set_status(self, job_info: JobInfo, status: str, current_time: datetime):
+        if self.info_store.upsert_entity(self.get_status_update(job_info, status, current_time), UpdateMode.MERGE):
+            return job_info
+
+    def set_statuses(self, job_infos: list[JobInfo], status: str, current_time: datetime) -> list[JobInfo]:
+        '''
+        Bulk version of set_status, infos in the same partition are updated with up to 100 per request.
+        '''
+        operations = [ ('upsert', self.get_status_update(job_info, status, current_time), { 'mode': UpdateMode.MERGE }) for job_info in job_infos ]
+        self.info_store.submit_transaction(operations)
+        return job_infos
+
+    def checkpoint_states(self, job_info: JobInfo):
+        '''
+        Merge only the states and update time of a running job, the other properties are saved when the run completes.
+        '''
+        if self.info_store.upsert_entity({ key: job_info[key] for key in ['PartitionKey', 'RowKey', 'states', 'update_time'] }, UpdateMode.MERGE):
+            return job_info
 
     def expire_job(self, job_info: JobInfo, current_time: datetime):
-        job_info['status'] = JobStatus.Expired
-        job_info['update_time'] = current_time
-        return self.upsert_info(job_info)
+        return self.set_status(job_info, JobStatus.Expired, current_time)
+
+    def expire_jobs(self, job_infos: list[JobInfo], current_time: datetime) -> list[JobInfo]:
+        return self.set_statuses(job_infos, JobStatus.Expired, current_time)
 
     def fail_job(self, job_info: JobInfo, current_time: datetime):
-        job_info['status'] = JobStatus.Failed
-        job_info['update_time'] = current_time
-        return self.upsert_info(job_info)
+        return self.set_status(job_info, JobStatus.Failed, current_time)
+
+    def fail_jobs(self, job_infos: list[JobInfo], current_time: datetime) -> list[JobInfo]:
+        return self.set_statuses(job_infos, JobStatus.Failed, current_time)
         
     def complete_run(self, success: bool, job_info: JobInfo, message: str, start_time: datetime):
+        if not has_failure_counters(job_info):
+            job_info['consecutive_failures'], job_info['total_failures'] = self.count_failures(job_info['RowKey'])
+        self.update_failure_counters(success, job_info)
         self.insert_run(job_info['RowKey'], start_time, job_info['update_time'], message, job_info['status'], not success)
         self.upsert_info(job_info)
         
     def insert_run(self, job_id: str, start_time: datetime, end_time: datetime, message: str, end_status: str, is_error: bool = False):
-        job_run: JobRun = {
-            "PartitionKey": job_id,
-            "RowKey": end_time.strftime('%Y%m%d%H%M%S%f') + '_' + job_id,
-            "is_error": is_error,
-            "message": message,
-            "end_status": end_status,
-            "start_time": start_time,
-            "end_time": end_time
-        }
+        job_run = self.create_run(job_id, start_time, end_time, message, end_status, is_error)
         if self.run_store.insert_entity(job_run):
             return job_run
 
+    def insert_runs(self, job_runs: list[JobRun]) -> list[JobRun]:
+        '''
+        Bulk insert runs created with create_run, runs of the same job are inserted with up to 100 per request.
+        '''
+        self.run_store.submit_transaction([ ('create', job_run) for job_run in job_runs ])
+        return job_runs
+
     '''
-    Get the number of consecutive failures and total number of failures for a job.
+    Get the number of consecutive failures and total number of failures for a job from the counters on the job info.
+    The counters are backfilled from the job runs if the info was written before they were kept.
     '''
     def summarize_failures(self, job_info: JobInfo) -> tuple[int, int]:
-        all_runs = self.run_store.query_entities(job_info['RowKey'])
-        consecutive_failure_count = 0
-        for run in sorted(all_runs, key=lambda x: x['start_time'], reverse=True):
-            if run['is_error']:
-                consecutive_failure_count += 1
-            else:
-                break
-        return consecutive_failure_count, sum(1 for run in all_runs if run['is_error'])
-    
-    def get_temp_file_path(self, container_name: str, blob_name: str) -> str:
-        dir_path = '{0}/{1}'.format(self.temp_dir, container_name)
-        os.makedirs(dir_path, exist_ok=True)
-        return dir_path + '/' + blob_name + '.tmp'
+        if not has_failure_counters(job_info):
+            self.backfill_failures(job_info)
+        return job_info['consecutive_failures'], job_info['total_failures']
+
+    '''
+    Count the failures by scanning all runs of a job, it is only needed to backfill the failure counters.
+    '''
+    def count_failures(self, job_id: str) -> tuple[int, int]:
+        return self.summarize_runs(list(self.list_runs(job_id, RUN_FAILURE_COLUMNS)))
+
+    def backfill_failures(self, job_info: JobInfo):
+        job_info['consecutive_failures'], job_info['total_failures'] = self.count_failures(job_info['RowKey'])
+        if self.info_store.upsert_entity(self.get_failure_counters(job_info), UpdateMode.MERGE):
+            return job_info
+
+    '''
+    One-time migration to backfill the failure counters for all infos of a job written before the counters were kept.
+    Return the number of infos backfilled.
+    '''
+    def backfill_all_failures(self, job_name: str) -> int:
+        backfilled = 0
+        for job_info in self.list_infos(job_name, INFO_SUMMARY_COLUMNS):
+            if not has_failure_counters(job_info):
+                self.backfill_failures(job_info)
+                backfilled += 1
+        return backfilled
     
-    def upload_file(self, container_name: str, blob_name: str, create_file_func: Callable[[str], bool]) -> bool:
+    def upload_file(self, container_name: str, blob_name: str, create_file_func: Callable[[str], bool]) -> UploadResult:
         file_path = self.get_temp_file_path(container_name, blob_name)
         if create_file_func(file_path):
-            return self.blob_store.upload(container_name, blob_name, file_path)
-        return False
+            try:
+                result = self.blob_store.upload(container_name, blob_name, file_path)
+            finally:
+                self.invalidate_exists(container_name, blob_name)
+            if result and self.blob_cache is not None:
+                self.blob_cache.record(container_name, blob_name, result.etag, file_path)
+            return result
+        return UploadResult(UploadResult.FileNotFound)
     
     def download_file(self, container_name: str, blob_name: str, load_data_func: Callable[[str], object]) -> object:
+        file_path = self.get_local_file(container_name, blob_name)
+        if file_path and load_data_func:
+            return load_data_func(file_path)
+
+    def upload_bytes(self, container_name: str, blob_name: str, data: Union[bytes, bytearray, memoryview]) -> UploadResult:
+        '''
+        Upload data held in memory without writing a temp file, see BlobStore.upload_bytes.
+        '''
+        try:
+            return self.blob_store.upload_bytes(container_name, blob_name, data)
+        finally:
+            self.invalidate_exists(container_name, blob_name)
+
+    def upload_stream(self, container_name: str, blob_name: str, stream: Union[BinaryIO, Iterable[bytes]], length: int = None) -> UploadResult:
+        '''
+        Upload a file-like object or an iterable of bytes chunks as it is read, without writing a temp file, see BlobStore.upload_stream.
+        '''
+        try:
+            return self.blob_store.upload_stream(container_name, blob_name, stream, length)
+        finally:
+            self.invalidate_exists(container_name, blob_name)
+
+    def download_bytes(self, container_name: str, blob_name: str) -> bytes:
+        '''
+        Return the content of a blob read into memory, or None if it does not exist. Neither a temp file nor the blob_cache is used,
+        use download_file or open_mapped for a local copy.
+        '''
+        return self.blob_store.download_bytes(container_name, blob_name)
+
+    def open_read_stream(self, container_name: str, blob_name: str):
+        '''
+        Return a stream of the blob content read as it is consumed, or None if it does not exist, see BlobStore.open_read_stream.
+        '''
+        return self.blob_store.open_read_stream(container_name, blob_name)
+
+    def open_mapped(self, container_name: str, blob_name: str) -> mmap.mmap:
+        '''
+        Return a read-only memory map of the local copy of a blob, downloading it first if needed, or None if the blob does not exist.
+        Processes mapping the same file share one copy in the page cache instead of reading it into their own memory. Close the map when
+        done, it stays valid if the cached file is replaced or evicted meanwhile. An empty blob can not be mapped, an empty memoryview is
+        returned instead.
+        '''
+        file_path = self.get_local_file(container_name, blob_name)
+        if file_path is None:
+            return None
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b'')
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get_local_file(self, container_name: str, blob_name: str) -> str:
+        '''
+        Return the path of the local copy of a blob from the blob_cache, or the temp file downloaded if it does not exist yet.
+        Return None if the blob does not exist.
+        '''
+        if self.blob_cache is not None:
+            return self.blob_cache.get(self.blob_store, container_name, blob_name)
         file_path = self.get_temp_file_path(container_name, blob_name)
         if not os.path.exists(file_path):
             self.blob_store.download(container_name, blob_name, file_path)
-        if os.path.exists(file_path) and load_data_func:
-            return load_data_func(file_path)
+        return file_path if os.path.exists(file_path) else None
         
     def delete_file(self, container_name: str, blob_name: str):
         file_path = self.get_temp_file_path(container_name, blob_name)
         if os.path.exists(file_path):
             os.remove(file_path)
-        return self.blob_store.delete(container_name, blob_name)
+        if self.blob_cache is not None:
+            self.blob_cache.remove(container_name, blob_name)
+        try:
+            return self.blob_store.delete(container_name, blob_name)
+        finally:
+            self.invalidate_exists(container_name, blob_name)
     
     def file_exists(self, container_name: str, blob_name: str) -> bool:
-        return self.blob_store.exists(container_name, blob_name)
+        if self.exists_cache is None:
+            return self.blob_store.exists(container_name, blob_name)
+        exists = self.exists_cache.get((container_name, blob_name))
+        if exists is None:
+            generation = self.exists_cache.get_generation((container_name, blob_name))
+            exists = self.blob_store.exists(container_name, blob_name)
+            self.exists_cache.put((container_name, blob_name), exists, generation)
+        return exists
         
+    def files_exist(self, blob_ids) -> set[tuple[str, str]]:
+        '''
+        Return the set of the (container_name, blob_name) tuples that exist, see BlobStore.exists_many. With an exists_cache,
+        only the blobs not cached are checked.
+        '''
+        if self.exists_cache is None:
+            return self.blob_store.exists_many(blob_ids)
+        existing, unknown = self.exists_cache.lookup(blob_ids)
+        if unknown:
+            generations = self.exists_cache.get_generations(unknown)
+            found = self.blob_store.exists_many(unknown)
+            self.exists_cache.update(unknown, found, generations)
+            existing |= found
+        return existing
+
     def lease_job(self, job_type: str, lease_duration: int = 15):
         return self.blob_store.lease_blob('BatchJobAdmin', job_type, lease_duration)
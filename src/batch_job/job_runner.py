@@ -1,6 +1,8 @@
+import asyncio
 from datetime import datetime, timedelta, timezone
 
-from batch_job.job_data import JobData, JobStatus
+from batch_job.async_base_job import AsyncBaseJob
+from batch_job.job_data import INFO_SUMMARY_COLUMNS, JobData
 from batch_job.job_settings import JobSettingsFactory, JobSettings
 
 
@@ -30,38 +32,48 @@ class JobRunner(object):
             self.internal_run(settings, revision, run_date)
 
     def internal_run(self, settings: JobSettings, revision: int, run_date: datetime):
-        # Get all existing job infos for the given job settings
+        # Get the existing job infos not in an end state for the given job settings
         current_time = datetime.now(timezone.utc)
-        all_infos = self.job_data.list_infos(settings.get_job_partition())
+        active_infos = self.job_data.list_active_infos(settings.get_job_partition(), INFO_SUMMARY_COLUMNS)
 
         # Check if any existing active, pending, or suspended job to resume, to fail or to expire.
         job_to_run = None
-        new_job_id = settings.get_job_id(run_date, revision)
-        for info in all_infos:
-            if new_job_id == info['RowKey']:
-                new_job_id = None # Set None to notify the new job id has been created.
-            if not JobStatus.is_end_state(info['status']):
-                # check and set failure
-                consecutive_failure_count, total_failure_count = self.job_data.summarize_failures(info)
-                if consecutive_failure_count >= settings.max_consecutive_failures or total_failure_count >= settings.max_failures:
-                    self.job_data.fail_job(info, current_time)
-                    self.set_failed.append(info['RowKey'])
-                # check and set expiration
-                elif current_time > info['create_time'] + timedelta(hours = settings.expire_hours):
-                    self.job_data.expire_job(info, current_time)
-                    self.set_expired.append(info['RowKey'])
-                # find the resumable jobs and only run the first one
-                elif not job_to_run:
-                    job_to_run = settings.job_class(self.job_data, info)
+        infos_to_fail = []
+        infos_to_expire = []
+        for info in active_infos:
+            # check and set failure
+            consecutive_failure_count, total_failure_count = self.job_data.summarize_failures(info)
+            if consecutive_failure_count >= settings.max_consecutive_failures or total_failure_count >= settings.max_failures:
+                infos_to_fail.append(info)
+            # check and set expiration
+            elif current_time > info['create_time'] + timedelta(hours = settings.expire_hours):
+                infos_to_expire.append(info)
+            # find the resumable jobs and only run the first one
+            elif not job_to_run:
+                job_to_run = settings.job_class(self.job_data, self.job_data.get_info(info['RowKey']))
+                job_to_run.info_saved = True # read from the table, checkpoints only merge the states
+
+        # Stale jobs are in the same partition, so they are failed or expired in bulk with a few requests.
+        if infos_to_fail:
+            self.job_data.fail_jobs(infos_to_fail, current_time)
+            self.set_failed.extend(info['RowKey'] for info in infos_to_fail)
+        if infos_to_expire:
+            self.job_data.expire_jobs(infos_to_expire, current_time)
+            self.set_expired.extend(info['RowKey'] for info in infos_to_expire)
 
         # If no existing to resume and the new job id has not been created, check the job schedule to see if a new job should be created.
-        if not job_to_run and new_job_id:
+        new_job_id = settings.get_job_id(run_date, revision)
+        if not job_to_run and not self.job_data.info_exists(new_job_id):
             if settings.job_schedule.check(current_time):
                 job_to_run = settings.job_class(self.job_data, settings.create_info(revision, run_date))
 
         # At most one job will be executed. After the job is executed, update job info and job run.
         if job_to_run:
-            if job_to_run.run():
+            if isinstance(job_to_run, AsyncBaseJob):
+                success = asyncio.run(job_to_run.run())
+            else:
+                success = job_to_run.run()
+            if success:
                 self.run_success.append(job_to_run.job_info['RowKey'])
             else:
                 self.run_with_error.append(job_to_run.job_info['RowKey'])
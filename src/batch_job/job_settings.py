@@ -5,7 +5,7 @@ import sys
 from typing import Type
 
 from batch_job import VERSION_OFFSET, REVISION_OFFSET
-from batch_job.base_job import BaseJob, BaseJobInputs, BaseJobStates
+from batch_job.base_job import BaseJob, BaseJobInputs, BaseJobStates, DEFAULT_CHUNK_SIZE, DEFAULT_THROTTLE_RETRIES
 from batch_job.job_data import JobInfo, JobStatus
 from batch_job.job_schedule import JobSchedule, schedule_from_crontab
 
@@ -49,7 +49,22 @@ class JobSettings(object):
                  job_class: Type[BaseJob],
                  job_type: str,
                  job_version: int,
-                 require_lock: bool):
+                 require_lock: bool,
+                 max_workers: int = 1,
+                 process_chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 drain_pages: bool = False,
+                 max_run_seconds: float = 0,
+                 prefetch_pages: int = 0,
+                 checkpoint_items: int = 0,
+                 checkpoint_seconds: float = 0,
+                 adaptive_batch_size: bool = False,
+                 rate_limit_per_second: float = 0,
+                 rate_burst: int = 1,
+                 max_throttle_retries: int = DEFAULT_THROTTLE_RETRIES,
+                 retry_max_attempts: int = 1,
+                 retry_base_seconds: float = 1.0,
+                 retry_max_seconds: float = 60.0,
+                 retryable_errors: list[str] = None):
         self.job_schedule = job_schedule
         self.date_format = date_format
         self.max_failures = max_failures
@@ -61,11 +76,34 @@ class JobSettings(object):
         self.job_type = job_type
         self.job_version = job_version
         self.require_lock = require_lock
+        self.max_workers = max_workers
+        self.process_chunk_size = process_chunk_size
+        self.drain_pages = drain_pages
+        self.max_run_seconds = max_run_seconds
+        self.prefetch_pages = prefetch_pages
+        self.checkpoint_items = checkpoint_items
+        self.checkpoint_seconds = checkpoint_seconds
+        self.adaptive_batch_size = adaptive_batch_size
+        self.rate_limit_per_second = rate_limit_per_second
+        self.rate_burst = rate_burst
+        self.max_throttle_retries = max_throttle_retries
+        self.retry_max_attempts = retry_max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.retryable_errors = retryable_errors or []
 
     def create_info(self, revision: int, run_date: datetime) -> JobInfo:
         if not run_date:
             run_date = datetime.now(timezone.utc)
-        inputs = pickle.dumps(BaseJobInputs(run_date=run_date, batch_size=self.batch_size, process_interval=self.process_interval_in_seconds))
+        inputs = pickle.dumps(BaseJobInputs(run_date=run_date, batch_size=self.batch_size, process_interval=self.process_interval_in_seconds,
+                                            max_workers=self.max_workers, process_chunk_size=self.process_chunk_size,
+                                            drain_pages=self.drain_pages, max_run_seconds=self.max_run_seconds,
+                                            prefetch_pages=self.prefetch_pages, checkpoint_items=self.checkpoint_items,
+                                            checkpoint_seconds=self.checkpoint_seconds, adaptive_batch_size=self.adaptive_batch_size,
+                                            rate_limit=self.rate_limit_per_second, rate_burst=self.rate_burst,
+                                            max_throttle_retries=self.max_throttle_retries, retry_max_attempts=self.retry_max_attempts,
+                                            retry_base_seconds=self.retry_base_seconds, retry_max_seconds=self.retry_max_seconds,
+                                            retryable_errors=self.retryable_errors))
         states = pickle.dumps(BaseJobStates(last_processed='', processed=0, skipped=0))
         return JobInfo(
             PartitionKey=self.get_job_partition(),
@@ -75,7 +113,9 @@ class JobSettings(object):
             states=states,
             status=JobStatus.Pending,
             create_time=datetime.now(timezone.utc),
-            update_time=datetime.now(timezone.utc))
+            update_time=datetime.now(timezone.utc),
+            consecutive_failures=0,
+            total_failures=0)
     
     def get_job_partition(self) -> str:
         return '{0}_{1}'.format(self.job_type, self.job_version + VERSION_OFFSET)
@@ -89,7 +129,21 @@ def convert_settings(raw_settings: dict) -> JobSettings:
     Convert dict settings to JobSettings object. 
     - These settings are required: job_class (the name of BaseJob subclass), job_type (the friendly name as the runner input)
     - For other settings, if they are missing, use default values: job_schedule = None (no constraint), date_format = '%Y%m%d', max_failures = 20,
-        max_consecutive_failures = 5, expire_hours = 24, batch_size = 1000, process_interval_in_seconds = 0, require_lock = False (no locking).
+        max_consecutive_failures = 5, expire_hours = 24, batch_size = 1000, process_interval_in_seconds = 0, require_lock = False (no locking),
+        max_workers = 1 (process items one at a time), process_chunk_size = 100 (items per process_batch call if the job overrides it),
+        drain_pages = False (load one page per run), max_run_seconds = 0 (no time budget),
+        prefetch_pages = 0 (load pages in the foreground), checkpoint_items = 0 and checkpoint_seconds = 0 (only save states between pages
+        and at the end of the run), adaptive_batch_size = False (use batch_size as is),
+        rate_limit_per_second = 0 (no limit), rate_burst = 1, max_throttle_retries = 5.
+    - Items are processed at up to rate_limit_per_second on average and rate_burst at once. If it is not set, process_interval_in_seconds is
+        used as a rate of one item per interval. When process_item raises ThrottledError or an HTTP 429 error, all workers back off and the
+        item is retried up to max_throttle_retries times.
+    - retry_max_attempts = 1 (no retry), retry_base_seconds = 1, retry_max_seconds = 60, retryable_errors = [] (all errors): an item failing with
+        one of retryable_errors (dotted class paths) is retried with exponential backoff and jitter. Only an error that is not retried ends
+        the iteration.
+    - With adaptive_batch_size and max_run_seconds, the batch size of each run is lowered to the number of items that fit max_run_seconds at
+        the average seconds per item measured in previous runs. batch_size stays the upper bound and is never raised, so set it well above
+        the expected items per run for adaptive_batch_size to also fill runs that are too short.
     - date_format is used to format the run_date in the job id. By default, the job id is unique for each calendar day.
     '''
     job_schedule = schedule_from_crontab(raw_settings.get('job_schedule', None))
@@ -103,7 +157,28 @@ def convert_settings(raw_settings: dict) -> JobSettings:
     job_type = str(raw_settings.get('job_type'))
     job_version = int(raw_settings.get('job_version', 1))
     require_lock = bool(raw_settings.get('require_lock', False))
-    return JobSettings(job_schedule, date_format, max_failures, max_consecutive_failures, expire_hours, batch_size, process_interval_in_seconds, job_class, job_type, job_version, require_lock)
+    max_workers = int(raw_settings.get('max_workers', 1))
+    process_chunk_size = int(raw_settings.get('process_chunk_size', DEFAULT_CHUNK_SIZE))
+    drain_pages = bool(raw_settings.get('drain_pages', False))
+    max_run_seconds = float(raw_settings.get('max_run_seconds', 0))
+    prefetch_pages = int(raw_settings.get('prefetch_pages', 0))
+    checkpoint_items = int(raw_settings.get('checkpoint_items', 0))
+    checkpoint_seconds = float(raw_settings.get('checkpoint_seconds', 0))
+    adaptive_batch_size = bool(raw_settings.get('adaptive_batch_size', False))
+    rate_limit_per_second = float(raw_settings.get('rate_limit_per_second', 0))
+    rate_burst = int(raw_settings.get('rate_burst', 1))
+    max_throttle_retries = int(raw_settings.get('max_throttle_retries', DEFAULT_THROTTLE_RETRIES))
+    retry_max_attempts = int(raw_settings.get('retry_max_attempts', 1))
+    retry_base_seconds = float(raw_settings.get('retry_base_seconds', 1.0))
+    retry_max_seconds = float(raw_settings.get('retry_max_seconds', 60.0))
+    retryable_errors = list(raw_settings.get('retryable_errors', []))
+    for error_path in retryable_errors:
+        import_string(error_path) # fail early on a wrong class path
+    return JobSettings(job_schedule, date_format, max_failures, max_consecutive_failures, expire_hours, batch_size, process_interval_in_seconds, job_class, job_type, job_version, require_lock,
+                       max_workers, process_chunk_size, drain_pages, max_run_seconds,
+                       prefetch_pages, checkpoint_items, checkpoint_seconds, adaptive_batch_size,
+                       rate_limit_per_second, rate_burst, max_throttle_retries, retry_max_attempts, retry_base_seconds, retry_max_seconds,
+                       retryable_errors)
 
 
 class JobSettingsFactory(object):
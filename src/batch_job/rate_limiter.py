@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+
+
+# The first pause after the downstream throttles, doubled for each further throttle until a call succeeds.
+INITIAL_BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 60.0
+
+
+class ThrottledError(Exception):
+    '''
+    Raise it from process_item when the downstream asks to slow down. retry_after is the pause in seconds it asked for, if any.
+    '''
+    def __init__(self, message: str = 'Throttled by downstream.', retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_throttled(err: Exception) -> bool:
+    '''
+    A ThrottledError, or an HTTP error with status 429 such as azure.core HttpResponseError or requests HTTPError.
+    '''
+    if isinstance(err, ThrottledError):
+        return True
+    status_code = getattr(err, 'status_code', None) or getattr(getattr(err, 'response', None), 'status_code', None)
+    return status_code == 429
+
+
+def get_retry_after(err: Exception) -> float:
+    retry_after = getattr(err, 'retry_after', None)
+    if retry_after is None:
+        headers = getattr(getattr(err, 'response', None), 'headers', None) or {}
+        retry_after = headers.get('Retry-After')
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return None # An HTTP date is not supported, fall back to the exponential backoff.
+
+
+class TokenBucket(object):
+    def __init__(self, rate: float = 0, burst: int = 1):
+        '''
+        Allow rate calls per second on average with bursts of up to burst calls, a rate of 0 means no limit. It is thread-safe and shared
+        by all workers of a job, so one throttled call pauses all of them with throttle().
+        '''
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.backoff_seconds = 0
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._backoff_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int = 1) -> float:
+        '''
+        Take tokens and return the seconds to wait before using them. The tokens are taken right away, so the callers
+        waiting at the same time are spread out.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            wait = 0
+            if self.rate > 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= tokens
+                if self._tokens < 0:
+                    wait = -self._tokens / self.rate
+            return max(wait, self._backoff_until - now)
+
+    def acquire(self, tokens: int = 1) -> float:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens: int = 1) -> float:
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def throttle(self, retry_after: float = None) -> float:
+        '''
+        Pause all callers for retry_after seconds, or for an exponential backoff if it is not given. Return the pause in seconds.
+        '''
+        with self._lock:
+            self.backoff_seconds = min(self.backoff_seconds * 2 or INITIAL_BACKOFF_SECONDS, MAX_BACKOFF_SECONDS)
+            pause = retry_after if retry_after is not None else self.backoff_seconds
+            now = time.monotonic()
+            self._backoff_until = max(self._backoff_until, now + pause)
+            if self.rate > 0:
+                self._tokens = min(self._tokens + (now - self._updated) * self.rate, 0)
+                self._updated = now
+            return pause
+
+    def succeed(self):
+        self.backoff_seconds = 0
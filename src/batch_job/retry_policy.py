@@ -0,0 +1,23 @@
+import random
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts: int = 1, base_seconds: float = 1.0, max_seconds: float = 60.0, retryable: tuple[type] = (Exception,)):
+        '''
+        Retry a failed call up to max_attempts calls in total if the error is an instance of one of the retryable classes. The wait before
+        each retry is a random time up to base_seconds doubled for each attempt and capped at max_seconds (exponential backoff with full jitter),
+        so workers failing at the same time do not retry at the same time.
+        '''
+        self.max_attempts = max_attempts
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.retryable = tuple(retryable)
+
+    def should_retry(self, err: Exception, attempt: int) -> bool:
+        '''
+        Whether to retry after the given attempt (starting from 1) failed with err.
+        '''
+        return attempt < self.max_attempts and isinstance(err, self.retryable)
+
+    def get_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_seconds, self.base_seconds * 2 ** (attempt - 1)))
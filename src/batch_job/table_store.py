@@ -1,44 +1,153 @@
 from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
 from azure.data.tables import TableServiceClient, TableClient, UpdateMode
+import threading
+from typing import Iterator
+
+from batch_job import CONNECTION_POOL_SIZE
+from batch_job.transport import create_transport
+
+
+# The maximum number of operations in one entity group transaction.
+MAX_TRANSACTION_SIZE = 100
+
+
+def create_table_service_client(conn_str: str, pool_size: int = CONNECTION_POOL_SIZE) -> TableServiceClient:
+    '''
+    Create a service client with its own connection pool. Table clients created from it share the pool, so it can be
+    passed to several TableStore objects to reuse the same connections for different tables.
+    '''
+    return TableServiceClient.from_connection_string(conn_str, transport=create_transport(pool_size))
+
+
+def build_partition_query(partition_key, rk_continuation_token="", query_filter: str = None, parameters: dict = None) -> tuple[str, dict]:
+    '''
+    Combine the partition filter with an optional extra filter, return the filter expression and its parameters.
+    '''
+    all_parameters = dict(parameters or {})
+    all_parameters.update({ "pk": partition_key, "rkt": rk_continuation_token })
+    full_filter = "PartitionKey eq @pk and RowKey gt @rkt"
+    if query_filter:
+        full_filter += " and ({0})".format(query_filter)
+    return full_filter, all_parameters
+
+
+def split_transactions(operations: list) -> Iterator[list]:
+    '''
+    Group operations by PartitionKey and split each group into transactions of up to 100 operations.
+    '''
+    groups = {}
+    for operation in operations:
+        groups.setdefault(operation[1]['PartitionKey'], []).append(operation)
+    for group in groups.values():
+        for i in range(0, len(group), MAX_TRANSACTION_SIZE):
+            yield group[i:i + MAX_TRANSACTION_SIZE]
 
 
 class TableStore(object):
-    def __init__(self, conn_str: str, table_name: str):
+    def __init__(self, conn_str: str, table_name: str, service_client: TableServiceClient = None, pool_size: int = CONNECTION_POOL_SIZE):
+        '''
+        The underlying clients are created on first use and kept open until close() is called. A shared service_client
+        is not closed by this object, its owner is responsible for closing it.
+        '''
         self.connection_string = conn_str
         self.table_name = table_name
+        self.pool_size = pool_size
+        self._service_client = service_client
+        self._owns_service_client = service_client is None
+        self._table_client = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def service_client(self) -> TableServiceClient:
+        with self._lock:
+            if self._service_client is None:
+                self._service_client = create_table_service_client(self.connection_string, self.pool_size)
+            return self._service_client
+
+    @property
+    def table_client(self) -> TableClient:
+        if self._table_client is None:
+            service_client = self.service_client
+            with self._lock:
+                if self._table_client is None:
+                    self._table_client = service_client.get_table_client(self.table_name)
+        return self._table_client
+
+    def close(self):
+        with self._lock:
+            if self._table_client is not None:
+                self._table_client.close()
+                self._table_client = None
+            if self._owns_service_client and self._service_client is not None:
+                self._service_client.close()
+                self._service_client = None
 
     def create_if_not_exist(self) -> TableClient:
-        with TableServiceClient.from_connection_string(self.connection_string) as table_service_client:
-            return table_service_client.create_table_if_not_exists(table_name=self.table_name)
-        
+        self.service_client.create_table_if_not_exists(table_name=self.table_name)
+        return self.table_client
+
     def delete_table(self):
-        with TableServiceClient.from_connection_string(self.connection_string) as table_service_client:
-            return table_service_client.delete_table(table_name=self.table_name)
-        
+        return self.service_client.delete_table(table_name=self.table_name)
+
     def insert_entity(self, data) -> bool:
-        with TableClient.from_connection_string(self.connection_string, self.table_name) as table:
-            try:
-                return table.create_entity(entity=data)
-            except ResourceExistsError:
-                return None
+        try:
+            return self.table_client.create_entity(entity=data)
+        except ResourceExistsError:
+            return None
 
     def upsert_entity(self, data, update_mode: UpdateMode = UpdateMode.REPLACE):
-        with TableClient.from_connection_string(self.connection_string, self.table_name) as table:
-            return table.upsert_entity(mode=update_mode, entity=data)
+        return self.table_client.upsert_entity(mode=update_mode, entity=data)
 
     def delete_entity(self, partition_key, row_key):
-        with TableClient.from_connection_string(self.connection_string, self.table_name) as table:
-            return table.delete_entity(row_key=row_key, partition_key=partition_key)
-
-    def get_entity(self, partition_key, row_key):
-        with TableClient.from_connection_string(self.connection_string, self.table_name) as table:
-            try:
-                return table.get_entity(row_key=row_key, partition_key=partition_key)
-            except ResourceNotFoundError:
-                return None
-        
+        return self.table_client.delete_entity(row_key=row_key, partition_key=partition_key)
+
+    def get_entity(self, partition_key, row_key, select: list[str] = None):
+        try:
+            return self.table_client.get_entity(row_key=row_key, partition_key=partition_key, select=select)
+        except ResourceNotFoundError:
+            return None
+
+    def query_pages(self, partition_key, rk_continuation_token="", select: list[str] = None, results_per_page: int = None,
+                    query_filter: str = None, parameters: dict = None, continuation_token=None):
+        '''
+        Query one partition page by page, yielding a tuple of (entities, continuation_token) for each page.
+        - select: the properties to return, all properties are returned if not set. PartitionKey and RowKey are only returned when selected.
+        - results_per_page: the maximum number of entities returned by one service request.
+        - query_filter: an extra filter expression combined with the partition filter, its @names are resolved from parameters.
+        - continuation_token: a token yielded by a previous query to resume after that page. It is None after the last page.
+        '''
+        full_filter, all_parameters = build_partition_query(partition_key, rk_continuation_token, query_filter, parameters)
+        pager = self.table_client.query_entities(full_filter, parameters=all_parameters, select=select,
+                                                 results_per_page=results_per_page).by_page(continuation_token=continuation_token)
+        for page in pager:
+            yield list(page), pager.continuation_token
+
+    def iter_entities(self, partition_key, rk_continuation_token="", select: list[str] = None, results_per_page: int = None,
+                      query_filter: str = None, parameters: dict = None):
+        '''
+        Stream the entities of one partition, only one page is held in memory at a time. See query_pages for the arguments.
+        '''
+        for entities, _ in self.query_pages(partition_key, rk_continuation_token, select, results_per_page, query_filter, parameters):
+            yield from entities
+
     def query_entities(self, partition_key, rk_continuation_token=""):
-        with TableClient.from_connection_string(self.connection_string, self.table_name) as table:
-            parameters = { "pk": partition_key, "rkt": rk_continuation_token }
-            query_filter = "PartitionKey eq @pk and RowKey gt @rkt"
-            return list(table.query_entities(query_filter, parameters=parameters))
+        return list(self.iter_entities(partition_key, rk_continuation_token))
+
+    def submit_transaction(self, operations: list) -> list:
+        '''
+        Submit operations as entity group transactions. An operation is a tuple of (operation type, entity) or (operation type, entity, options)
+        as for TableClient.submit_transaction, e.g. ('upsert', entity, {'mode': UpdateMode.MERGE}). Operations are grouped by PartitionKey and
+        each group is submitted in transactions of up to 100 operations. Each transaction is atomic, a failed one raises TableTransactionError
+        and the transactions after it are not submitted.
+        Return the results of all operations, ordered by partition group.
+        '''
+        results = []
+        for transaction in split_transactions(operations):
+            results.extend(self.table_client.submit_transaction(transaction))
+        return results
@@ -0,0 +1,31 @@
+from azure.core.pipeline.transport import RequestsTransport
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from batch_job import CONNECTION_POOL_SIZE
+
+
+def create_transport(pool_size: int = CONNECTION_POOL_SIZE) -> RequestsTransport:
+    '''
+    Create an HTTP transport that keeps up to pool_size connections alive per host. Clients sharing the transport reuse
+    the pooled connections instead of doing a new TCP/TLS handshake for every call. Retries are left to the SDK pipeline.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=Retry(total=False, redirect=False, raise_on_status=False))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return RequestsTransport(session=session, session_owner=True)
+
+
+def create_async_transport(pool_size: int = CONNECTION_POOL_SIZE):
+    '''
+    Async version of create_transport for the asyncio storage layer. It must be called with a running event loop.
+    '''
+    # aiohttp is an optional dependency only required by the asyncio storage layer.
+    import aiohttp
+    from azure.core.pipeline.transport import AioHttpTransport
+    # Same session options as the SDK uses for the sessions it creates.
+    session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=pool_size), cookie_jar=aiohttp.DummyCookieJar(), auto_decompress=False)
+    return AioHttpTransport(session=session, session_owner=True)
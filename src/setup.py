@@ -18,6 +18,10 @@ setup(
         'azure-storage-blob'
     ],
 
+    extras_require={
+        'async': ['aiohttp']
+    },
+
     classifiers=[
         'Intended Audience :: Developers',
 
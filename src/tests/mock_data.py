@@ -1,8 +1,32 @@
+import operator
 import os
 
+from batch_job.async_blob_store import AsyncBlobStore
+from batch_job.async_job_data import AsyncJobData
+from batch_job.async_table_store import AsyncTableStore
 from batch_job.job_data import JobData
 from batch_job.table_store import TableStore, UpdateMode
-from batch_job.blob_store import BlobStore
+from batch_job.blob_cache import LocalBlobCache
+from batch_job.blob_store import BlobStore, CleanUpResult, DownloadResult, UploadResult
+from batch_job.exists_cache import ExistsCache
+
+
+FILTER_OPERATORS = {
+    'eq': operator.eq, 'ne': operator.ne, 'gt': operator.gt, 'ge': operator.ge, 'lt': operator.lt, 'le': operator.le
+}
+
+
+def match_filter(entity, query_filter, parameters):
+    '''
+    Evaluate a filter of "property op @parameter" conditions joined by "and", which is all the job data queries use.
+    '''
+    if not query_filter:
+        return True
+    for condition in query_filter.strip('()').split(' and '):
+        name, op, value = condition.strip('()').split(' ')
+        if not FILTER_OPERATORS[op](entity.get(name), parameters[value.lstrip('@')]):
+            return False
+    return True
 
 
 class InMemoryTableStore(TableStore):
@@ -37,16 +61,40 @@ class InMemoryTableStore(TableStore):
             if row_key in self._entities[partition_key]:
                 del self._entities[partition_key][row_key]
 
-    def get_entity(self, partition_key, row_key):
+    def get_entity(self, partition_key, row_key, select=None):
         if partition_key in self._entities:
             if row_key in self._entities[partition_key]:
-                return self._entities[partition_key][row_key]
+                entity = self._entities[partition_key][row_key]
+                if select:
+                    return { key: value for key, value in entity.items() if key in select }
+                return entity
         
-    def query_entities(self, partition_key, rk_continuation_token=""):
-        if partition_key in self._entities:
-            return list([ entity for row_key, entity in self._entities[partition_key].items() if row_key > rk_continuation_token ])
-        return []
+    def query_pages(self, partition_key, rk_continuation_token="", select=None, results_per_page=None,
+                    query_filter=None, parameters=None, continuation_token=None):
+        start_key = max(rk_continuation_token, continuation_token or "")
+        entities = [ entity for row_key, entity in sorted(self._entities.get(partition_key, {}).items())
+                     if row_key > start_key and match_filter(entity, query_filter, parameters) ]
+        page_size = results_per_page or 1000
+        for i in range(0, len(entities), page_size):
+            page = entities[i:i + page_size]
+            next_token = page[-1]["RowKey"] if i + page_size < len(entities) else None
+            if select:
+                page = [ { key: value for key, value in entity.items() if key in select } for entity in page ]
+            yield page, next_token
     
+    def submit_transaction(self, operations: list) -> list:
+        results = []
+        for operation in operations:
+            operation_type, entity = operation[0], operation[1]
+            options = operation[2] if len(operation) > 2 else {}
+            if operation_type == 'create':
+                results.append(self.insert_entity(entity))
+            elif operation_type in ['upsert', 'update']:
+                results.append(self.upsert_entity(entity, options.get('mode', UpdateMode.MERGE)))
+            elif operation_type == 'delete':
+                results.append(self.delete_entity(entity['PartitionKey'], entity['RowKey']))
+        return results
+
 
 class LocalBlobStore(BlobStore):
     def __init__(self, connection_string):
@@ -84,27 +132,143 @@ class LocalBlobStore(BlobStore):
         blob_id = self.get_blob_id(container_name, blob_name)
         return blob_id in self.local_files
 
+    def exists_many(self, blob_ids) -> set[tuple[str, str]]:
+        return { tuple(blob_id) for blob_id in blob_ids if self.exists(*blob_id) }
+
     def delete(self, container_name, blob_name) -> bool:
         blob_id = self.get_blob_id(container_name, blob_name)
         if blob_id in self.local_files:
             del self.local_files[blob_id]
 
-    def clean_up(self, container_name, least_blob_name: str) -> list[str]:
-        deleted = []
-        for blob_id in list(self.local_files.keys()):
-            if blob_id.split('/')[0] == container_name:
-                if blob_id < least_blob_name:
-                    deleted.append(blob_id)
-        for blob_id in deleted:
-            del self.local_files[blob_id]
-        return deleted
+    def clean_up(self, container_name, least_blob_name: str, prefix: str = None, max_deletes: int = None) -> CleanUpResult:
+        result = CleanUpResult()
+        for blob_id in sorted(self.local_files.keys()):
+            blob_container, blob_name = blob_id.split('/', 1)
+            if blob_container == container_name and blob_name < least_blob_name and blob_name.startswith(prefix or ''):
+                if max_deletes is not None and result.deleted >= max_deletes:
+                    result.stopped_early = True
+                    break
+                del self.local_files[blob_id]
+                result.deleted += 1
+        return result
 
     def lease_blob(self, container_name, blob_name, lease_duration=15):
         pass
 
 
+class VersionedBlobStore(LocalBlobStore):
+    '''
+    Blobs kept in memory with an ETag changing on each write, for the conditional downloads of LocalBlobCache.
+    '''
+    def __init__(self, connection_string):
+        super().__init__(connection_string)
+        self.blobs = {}
+        self.writes = 0
+        self.downloads = 0
+
+    def put(self, container_name, blob_name, data: bytes):
+        self.writes += 1
+        self.blobs[(container_name, blob_name)] = ('"0x{0}"'.format(self.writes), data)
+
+    def upload(self, container_name, blob_name, file_path, max_concurrency=None) -> UploadResult:
+        if (container_name, blob_name) in self.blobs:
+            return UploadResult(UploadResult.AlreadyExists)
+        with open(file_path, 'rb') as f:
+            self.put(container_name, blob_name, f.read())
+        return UploadResult(UploadResult.Created, self.blobs[(container_name, blob_name)][0])
+
+    def download(self, container_name, blob_name, file_path, max_concurrency=None, if_none_match=None) -> DownloadResult:
+        if (container_name, blob_name) not in self.blobs:
+            return DownloadResult(DownloadResult.NotFound)
+        etag, data = self.blobs[(container_name, blob_name)]
+        if etag == if_none_match:
+            return DownloadResult(DownloadResult.NotModified, etag)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        self.downloads += 1
+        return DownloadResult(DownloadResult.Downloaded, etag, len(data))
+
+
 class MockJobData(JobData):
-    def __init__(self, conn_str: str):
+    def __init__(self, conn_str: str, inverted_run_keys: bool = False, exists_cache: ExistsCache = None, blob_cache: LocalBlobCache = None):
+        self.inverted_run_keys = inverted_run_keys
+        self.exists_cache = exists_cache
+        self.blob_cache = blob_cache
         self.info_store = InMemoryTableStore(conn_str, "JobInfo")
         self.run_store = InMemoryTableStore(conn_str, "JobRun")
         self.blob_store = LocalBlobStore(conn_str)
+
+
+class AsyncInMemoryTableStore(AsyncTableStore):
+    def __init__(self, conn_str: str, table_name: str):
+        super().__init__(conn_str, table_name)
+        self._store = InMemoryTableStore(conn_str, table_name)
+
+    async def close(self):
+        pass
+
+    async def create_if_not_exist(self) -> None:
+        pass
+
+    async def delete_table(self):
+        self._store.delete_table()
+
+    async def insert_entity(self, data) -> bool:
+        return self._store.insert_entity(data)
+
+    async def upsert_entity(self, data, update_mode: UpdateMode = UpdateMode.REPLACE):
+        return self._store.upsert_entity(data, update_mode)
+
+    async def delete_entity(self, partition_key, row_key):
+        return self._store.delete_entity(partition_key, row_key)
+
+    async def get_entity(self, partition_key, row_key, select=None):
+        return self._store.get_entity(partition_key, row_key, select)
+
+    async def query_pages(self, partition_key, rk_continuation_token="", select=None, results_per_page=None,
+                          query_filter=None, parameters=None, continuation_token=None):
+        for page in self._store.query_pages(partition_key, rk_continuation_token, select, results_per_page, query_filter, parameters, continuation_token):
+            yield page
+
+    async def submit_transaction(self, operations: list) -> list:
+        return self._store.submit_transaction(operations)
+
+
+class AsyncLocalBlobStore(AsyncBlobStore):
+    def __init__(self, connection_string):
+        super().__init__(connection_string)
+        self._store = LocalBlobStore(connection_string)
+
+    async def close(self):
+        pass
+
+    async def upload(self, container_name, blob_name, file_path) -> bool:
+        return self._store.upload(container_name, blob_name, file_path)
+
+    async def download(self, container_name, blob_name, file_path) -> bool:
+        return self._store.download(container_name, blob_name, file_path)
+
+    async def exists(self, container_name, blob_name) -> bool:
+        return self._store.exists(container_name, blob_name)
+
+    async def exists_many(self, blob_ids) -> set[tuple[str, str]]:
+        return self._store.exists_many(blob_ids)
+
+    async def delete(self, container_name, blob_name) -> bool:
+        return self._store.delete(container_name, blob_name)
+
+    async def clean_up(self, container_name, least_blob_name: str, prefix: str = None, max_deletes: int = None) -> CleanUpResult:
+        return self._store.clean_up(container_name, least_blob_name, prefix, max_deletes)
+
+    async def lease_blob(self, container_name, blob_name, lease_duration=15):
+        return self._store.lease_blob(container_name, blob_name, lease_duration)
+
+
+class MockAsyncJobData(AsyncJobData):
+    def __init__(self, conn_str: str, temp_dir: str = 'BatchJobTemp', inverted_run_keys: bool = False, exists_cache: ExistsCache = None):
+        self.info_store = AsyncInMemoryTableStore(conn_str, "JobInfo")
+        self.run_store = AsyncInMemoryTableStore(conn_str, "JobRun")
+        self.blob_store = AsyncLocalBlobStore(conn_str)
+        self.temp_dir = temp_dir
+        self.inverted_run_keys = inverted_run_keys
+        self.exists_cache = exists_cache
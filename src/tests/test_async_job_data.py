@@ -0,0 +1,52 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+import os
+import shutil
+
+from batch_job.job_data import INFO_SUMMARY_COLUMNS, JobStatus
+from batch_job.job_settings import JobSettingsFactory
+from tests.mock_data import MockAsyncJobData
+
+
+class TestAsyncJobData(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.job_data = MockAsyncJobData('connection_string', 'AsyncBatchJobTemp')
+        self.settings = JobSettingsFactory({}).create('AsyncJob1')
+
+    def tearDown(self):
+        shutil.rmtree('AsyncBatchJobTemp', ignore_errors=True)
+
+    async def test_infos_and_runs(self):
+        current_time = datetime.now(timezone.utc)
+        for revision, status in enumerate([JobStatus.Pending, JobStatus.Completed, JobStatus.Suspended]):
+            info = self.settings.create_info(revision, current_time)
+            info['status'] = status
+            await self.job_data.upsert_info(info)
+
+        active_infos = [info async for info in self.job_data.list_active_infos(self.settings.get_job_partition(), INFO_SUMMARY_COLUMNS)]
+        self.assertEqual([info['status'] for info in active_infos], [JobStatus.Pending, JobStatus.Suspended])
+        self.assertTrue(await self.job_data.info_exists(active_infos[0]['RowKey']))
+
+        # Run the suspended job with an error, then expire the pending one
+        job_info = await self.job_data.get_info(active_infos[1]['RowKey'])
+        job_info['update_time'] = current_time + timedelta(minutes=1)
+        await self.job_data.complete_run(False, job_info, 'fail1', current_time)
+        self.assertEqual(await self.job_data.summarize_failures(job_info), (1, 1))
+        runs = await self.job_data.latest_runs(job_info['RowKey'], 5)
+        self.assertEqual([run['message'] for run in runs], ['fail1'])
+
+        await self.job_data.expire_jobs([active_infos[0]], current_time)
+        self.assertEqual((await self.job_data.get_info(active_infos[0]['RowKey']))['status'], JobStatus.Expired)
+
+    async def test_files(self):
+        def create_file(file_path):
+            with open(file_path, 'wt') as f:
+                f.write('async test')
+            return True
+
+        self.assertTrue(await self.job_data.upload_file('test_container3', 'test_blob3', create_file))
+        self.assertTrue(await self.job_data.file_exists('test_container3', 'test_blob3'))
+        self.assertEqual(await self.job_data.download_file('test_container3', 'test_blob3', lambda path: open(path).read()), 'async test')
+        await self.job_data.delete_file('test_container3', 'test_blob3')
+        self.assertFalse(await self.job_data.file_exists('test_container3', 'test_blob3'))
+        self.assertFalse(os.path.exists(self.job_data.get_temp_file_path('test_container3', 'test_blob3')))
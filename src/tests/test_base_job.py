@@ -1,10 +1,15 @@
+import asyncio
 import unittest
 from datetime import datetime, timedelta, timezone
 import pickle
-from unittest.mock import MagicMock
+import threading
+import time
+from unittest.mock import AsyncMock, MagicMock
 
+from batch_job.async_base_job import AsyncBaseJob
 from batch_job.base_job import BaseJob, JobStatus, JobInfo
-from tests.mock_data import MockJobData
+from batch_job.rate_limiter import ThrottledError
+from tests.mock_data import MockAsyncJobData, MockJobData
 
 
 class TestBaseJob(unittest.TestCase):
@@ -21,6 +26,12 @@ class TestBaseJob(unittest.TestCase):
             update_time=datetime.now(timezone.utc))
         self.job = BaseJob(self.job_data, self.job_info)
 
+    def create_job(self, job_class=BaseJob, **inputs) -> BaseJob:
+        job_inputs = pickle.loads(self.job_info['inputs'])
+        job_inputs.update(inputs)
+        self.job_info['inputs'] = pickle.dumps(job_inputs)
+        return job_class(self.job_data, self.job_info)
+
     def test_get_type(self):
         self.assertEqual(self.job.get_type(), "BaseJob")
 
@@ -70,7 +81,7 @@ class TestBaseJob(unittest.TestCase):
         info = self.job_data.get_info(self.job_info['RowKey'])
         self.assertIsNotNone(info)
         self.assertEqual(info['status'], JobStatus.Completed)
-        runs = self.job_data.list_runs(self.job_info['RowKey'])
+        runs = list(self.job_data.list_runs(self.job_info['RowKey']))
         self.assertEqual(len(runs), 1)
         self.assertEqual(runs[0]['end_status'], JobStatus.Completed)
 
@@ -81,6 +92,231 @@ class TestBaseJob(unittest.TestCase):
         info = self.job_data.get_info(self.job_info['RowKey'])
         self.assertIsNotNone(info)
         self.assertEqual(info['status'], JobStatus.Suspended)
-        runs = self.job_data.list_runs(self.job_info['RowKey'])
+        runs = list(self.job_data.list_runs(self.job_info['RowKey']))
         self.assertEqual(len(runs), 1)
         self.assertEqual(runs[0]['is_error'], True)
+
+    def test_internal_run_concurrently(self):
+        job = self.create_job(batch_size=7, max_workers=3)
+        job.load_items = MagicMock(return_value=(True, list(range(1, 11))))
+        # Later items finish first, odd items are skipped
+        job.process_item = lambda item: time.sleep(0.01 * (10 - item)) or item % 2 == 0
+
+        self.assertTrue(job.run())
+        self.assertEqual(job.job_states, {'last_processed': '7', 'processed': 3, 'skipped': 4})
+        self.assertEqual(job.message, 'Job BaseJob is suspended for reaching batch size 7 after handling 7 with ending item 7.')
+
+    def test_internal_run_concurrently_with_error(self):
+        job = self.create_job(max_workers=4)
+        job.load_items = MagicMock(return_value=(True, list(range(1, 11))))
+
+        def process_item(item):
+            if item == 5:
+                time.sleep(0.05)
+                raise Exception('Item 5 failed')
+            return True
+        job.process_item = process_item
+
+        # Items after the failed one may have finished, but last_processed only covers the contiguous ones
+        self.assertFalse(job.run())
+        self.assertEqual(job.job_states, {'last_processed': '4', 'processed': 4, 'skipped': 0})
+        self.assertEqual(self.job_info['status'], JobStatus.Suspended)
+        self.assertEqual(job.message, 'Job failed with error: Item 5 failed')
+
+    def test_async_job_run_with_error(self):
+        job = self.create_job(AsyncBaseJob, max_workers=4)
+        job.load_items = AsyncMock(return_value=(True, list(range(1, 11))))
+
+        async def process_item(item):
+            await asyncio.sleep(0.01)
+            if item == 3:
+                raise Exception('Item 3 failed')
+            return True
+        job.process_item = process_item
+
+        self.assertFalse(asyncio.run(job.run()))
+        self.assertEqual(job.job_states, {'last_processed': '2', 'processed': 2, 'skipped': 0})
+        self.assertEqual(self.job_info['status'], JobStatus.Suspended)
+
+    def test_async_job_with_async_job_data(self):
+        job_data = MockAsyncJobData('connection_string')
+        job = AsyncBaseJob(job_data, self.job_info)
+        job.job_inputs.update({'max_workers': 2, 'checkpoint_items': 4})
+        job.list_expected = MagicMock(return_value=[('test_container1', 'test_blob1')])
+        job.load_items = AsyncMock(return_value=(True, list(range(1, 11))))
+        job.process_item = AsyncMock(return_value=True)
+        writes = []
+
+        def record(name, func):
+            async def recorded(info):
+                writes.append((name, pickle.loads(info['states'])['last_processed']))
+                return await func(info)
+            return recorded
+        job_data.upsert_info = record('upsert', job_data.upsert_info)
+        job_data.checkpoint_states = record('merge', job_data.checkpoint_states)
+
+        # The dependencies, checkpoints and results are awaited on the async job data
+        self.assertTrue(asyncio.run(job.run()))
+        self.assertEqual(writes, [('upsert', '4'), ('merge', '8'), ('upsert', '10')])
+        info = asyncio.run(job_data.get_info(self.job_info['RowKey']))
+        self.assertEqual(info['status'], JobStatus.Completed)
+        self.assertEqual(len(asyncio.run(job_data.latest_runs(self.job_info['RowKey'], 5))), 1)
+
+    def test_internal_run_with_process_batch(self):
+        job = self.create_job(batch_size=8, process_chunk_size=3)
+        job.load_items = MagicMock(return_value=(True, list(range(1, 11))))
+        job.process_item = MagicMock()
+        job.process_batch = MagicMock(side_effect=lambda items: [item % 2 == 0 for item in items])
+
+        self.assertTrue(job.run())
+        self.assertEqual([call.args[0] for call in job.process_batch.call_args_list], [[1, 2, 3], [4, 5, 6], [7, 8]])
+        job.process_item.assert_not_called()
+        self.assertEqual(job.job_states, {'last_processed': '8', 'processed': 4, 'skipped': 4})
+        self.assertEqual(job.message, 'Job BaseJob is suspended for reaching batch size 8 after handling 8 with ending item 8.')
+
+    def test_internal_run_drains_pages(self):
+        job = self.create_job(batch_size=7, drain_pages=True)
+        pages = {'': (False, [1, 2, 3]), '3': (False, [4, 5, 6]), '6': (False, [7, 8, 9])}
+        job.load_items = MagicMock(side_effect=lambda last_processed: pages[last_processed])
+        job.process_item = MagicMock(return_value=True)
+        job.job_data.upsert_info = MagicMock(wraps=job.job_data.upsert_info)
+        job.job_data.checkpoint_states = MagicMock(wraps=job.job_data.checkpoint_states)
+
+        self.assertTrue(job.run())
+        self.assertEqual([call.args[0] for call in job.load_items.call_args_list], ['', '3', '6'])
+        self.assertEqual(job.job_states, {'last_processed': '7', 'processed': 7, 'skipped': 0})
+        # Checkpointed before the second and third pages, the first one writes the whole info of the new job
+        self.assertEqual(job.job_data.upsert_info.call_count, 2)
+        self.assertEqual(job.job_data.checkpoint_states.call_count, 1)
+        self.assertEqual(job.message, 'Job BaseJob is suspended for reaching batch size 7 after handling 7 with ending item 7.')
+
+    def test_internal_run_drains_iterator_pages(self):
+        pages = {'': (False, [1, 2, 3]), '3': (False, [4, 5]), '5': (True, [6])}
+
+        def load_items(last_processed):
+            all_loaded, items = pages[last_processed]
+            return all_loaded, (item for item in items)
+
+        for job_class, prefetch_pages in [(BaseJob, 0), (BaseJob, 2), (AsyncBaseJob, 0)]:
+            self.job_info['states'] = pickle.dumps({"last_processed": "", "processed": 0, "skipped": 0})
+            self.job_info['status'] = JobStatus.Pending
+            job = self.create_job(job_class, drain_pages=True, prefetch_pages=prefetch_pages)
+            if job_class is AsyncBaseJob:
+                job.load_items = AsyncMock(side_effect=load_items)
+                job.process_item = AsyncMock(return_value=True)
+                self.assertTrue(asyncio.run(job.run()))
+            else:
+                job.load_items = MagicMock(side_effect=load_items)
+                job.process_item = MagicMock(return_value=True)
+                self.assertTrue(job.run())
+            # The next page is loaded after the last item taken from the generator
+            self.assertEqual([call.args[0] for call in job.load_items.call_args_list], ['', '3', '5'])
+            self.assertEqual(job.job_states, {'last_processed': '6', 'processed': 6, 'skipped': 0})
+            self.assertEqual(self.job_info['status'], JobStatus.Completed)
+
+    def test_internal_run_with_time_budget(self):
+        job = self.create_job(max_run_seconds=0.05)
+
+        def load_pages(last_processed):
+            for page in range(100):
+                yield False, list(range(page * 10, page * 10 + 10))
+        job.load_pages = load_pages
+        job.process_item = lambda item: time.sleep(0.01) or True
+
+        self.assertTrue(job.run())
+        self.assertLess(job.job_states['processed'], 20)
+        self.assertEqual(self.job_info['status'], JobStatus.Active)
+        self.assertTrue(job.message.startswith('Job BaseJob is suspended for reaching time budget of 0.05 seconds'))
+        info = self.job_data.get_info(self.job_info['RowKey'])
+        self.assertEqual(pickle.loads(info['states']), job.job_states)
+
+    def test_internal_run_prefetches_pages(self):
+        job = self.create_job(drain_pages=True, prefetch_pages=1)
+        pages = {'': (False, [1, 2, 3]), '3': (False, [4, 5, 6]), '6': (True, [7])}
+        second_page_loaded = threading.Event()
+
+        def load_items(last_processed):
+            if last_processed == '3':
+                second_page_loaded.set()
+            return pages[last_processed]
+        job.load_items = load_items
+        prefetched = []
+        job.process_item = lambda item: prefetched.append(second_page_loaded.wait(1)) or True
+
+        self.assertTrue(job.run())
+        # The second page is loaded while the first one is processed
+        self.assertTrue(prefetched[0])
+        self.assertEqual(job.job_states, {'last_processed': '7', 'processed': 7, 'skipped': 0})
+        self.assertEqual(self.job_info['status'], JobStatus.Completed)
+
+    def test_internal_run_checkpoints_every_n_items(self):
+        job = self.create_job(checkpoint_items=3)
+        job.load_items = MagicMock(return_value=(True, list(range(1, 11))))
+
+        def process_item(item):
+            if item == 8:
+                raise Exception('Process killed')
+            return True
+        job.process_item = process_item
+        checkpoints = []
+        job.job_data.upsert_info = lambda info: checkpoints.append(('upsert', pickle.loads(info['states'])['last_processed']))
+        job.job_data.checkpoint_states = lambda info: checkpoints.append(('merge', pickle.loads(info['states'])['last_processed']))
+
+        self.assertFalse(job.run())
+        self.assertEqual(checkpoints, [('upsert', '3'), ('merge', '6'), ('upsert', '7')])
+
+    def test_adaptive_batch_size(self):
+        job = self.create_job(max_run_seconds=60, adaptive_batch_size=True)
+        self.assertEqual(job.batch_size, 1000)  # nothing measured yet
+
+        job.load_items = MagicMock(return_value=(False, list(range(1, 5))))
+        job.process_item = lambda item: time.sleep(0.01) or True
+        self.assertTrue(job.run())
+        self.assertGreaterEqual(job.job_states['avg_item_seconds'], 0.01)
+
+        self.job_info['states'] = pickle.dumps(dict(job.job_states, avg_item_seconds=0.5))
+        job = BaseJob(self.job_data, self.job_info)
+        self.assertEqual(job.batch_size, 120)
+        job.record_item_seconds(10, 10)
+        self.assertEqual(job.job_states['avg_item_seconds'], 0.75)
+
+    def test_internal_run_retries_throttled_items(self):
+        job = self.create_job(max_workers=3, rate_limit=1000, rate_burst=5)
+        job.load_items = MagicMock(return_value=(True, list(range(1, 11))))
+        throttled = []
+
+        def process_item(item):
+            if item == 4 and not throttled:
+                throttled.append(item)
+                raise ThrottledError(retry_after=0.01)
+            return True
+        job.process_item = process_item
+
+        self.assertTrue(job.run())
+        self.assertEqual(throttled, [4])
+        self.assertEqual(job.job_states, {'last_processed': '10', 'processed': 10, 'skipped': 0})
+        self.assertEqual(self.job_info['status'], JobStatus.Completed)
+
+    def test_process_interval_as_rate_limit(self):
+        job = self.create_job(process_interval=0.01, max_throttle_retries=2)
+        self.assertEqual((job.rate_limiter.rate, job.rate_limiter.burst), (100, 1))
+        job.process_item = MagicMock(side_effect=[ThrottledError(retry_after=0)] * 3)
+        self.assertRaises(ThrottledError, job.call_with_limit, job.process_item, 1)
+        self.assertEqual(job.process_item.call_count, 3)
+
+    def test_internal_run_retries_failed_items(self):
+        job = self.create_job(retry_max_attempts=3, retry_base_seconds=0.01, retryable_errors=['builtins.ConnectionError'])
+        job.load_items = MagicMock(return_value=(True, list(range(1, 11))))
+        failures = {2: 2, 5: 1, 8: 3}
+
+        def process_item(item):
+            if failures.get(item, 0) > 0:
+                failures[item] -= 1
+                raise ConnectionError('Connection reset')
+            return True
+        job.process_item = process_item
+
+        # Items 2 and 5 succeed on retry, item 8 fails 3 attempts and ends the iteration
+        self.assertFalse(job.run())
+        self.assertEqual(job.job_states, {'last_processed': '7', 'processed': 7, 'skipped': 0, 'retries': 5})
+        self.assertEqual(job.message, 'Job failed with error: Connection reset')
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from batch_job import TEMP_DIR
+from batch_job.blob_cache import LocalBlobCache
+from batch_job.job_data import JobData
+from tests.mock_data import MockJobData, VersionedBlobStore
+
+
+class TestLocalBlobCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.blob_store = VersionedBlobStore('connection_string')
+        self.blob_store.put('inputs', 'blob1', b'version 1')
+        self.cache = LocalBlobCache(self.cache_dir, max_bytes=20)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def read(self, file_path):
+        with open(file_path, 'rb') as f:
+            return f.read()
+
+    def test_revalidate_with_etag(self):
+        file_path = self.cache.get(self.blob_store, 'inputs', 'blob1')
+        self.assertEqual(self.read(file_path), b'version 1')
+        self.assertEqual(self.cache.get(self.blob_store, 'inputs', 'blob1'), file_path)
+        self.assertEqual((self.cache.hits, self.cache.misses, self.blob_store.downloads), (1, 1, 1))
+
+        # The blob changed, the cached copy is replaced
+        self.blob_store.put('inputs', 'blob1', b'version 2')
+        self.assertEqual(self.read(self.cache.get(self.blob_store, 'inputs', 'blob1')), b'version 2')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_metadata_of_replaced_file_is_ignored(self):
+        file_path = self.cache.get(self.blob_store, 'inputs', 'blob1')
+        # Another writer replaces the file without its metadata
+        with open(file_path + '.other', 'wb') as f:
+            f.write(b'other data')
+        os.replace(file_path + '.other', file_path)
+        self.assertEqual(self.read(self.cache.get(self.blob_store, 'inputs', 'blob1')), b'version 1')
+        self.assertEqual(self.blob_store.downloads, 2)
+
+    def test_missing_blob_removes_cached_copy(self):
+        file_path = self.cache.get(self.blob_store, 'inputs', 'blob1')
+        del self.blob_store.blobs[('inputs', 'blob1')]
+        self.assertIsNone(self.cache.get(self.blob_store, 'inputs', 'blob1'))
+        self.assertFalse(os.path.exists(file_path))
+        self.assertFalse(os.path.exists(file_path + '.meta'))
+
+    def test_evict_least_recently_used(self):
+        self.blob_store.put('inputs', 'blob2', b'version 1')
+        self.blob_store.put('inputs', 'blob3', b'version 1')
+        path1 = self.cache.get(self.blob_store, 'inputs', 'blob1')
+        time.sleep(0.01)
+        path2 = self.cache.get(self.blob_store, 'inputs', 'blob2')
+        time.sleep(0.01)
+        self.cache.get(self.blob_store, 'inputs', 'blob1') # blob1 is used again, blob2 is the least recently used
+        time.sleep(0.01)
+        path3 = self.cache.get(self.blob_store, 'inputs', 'blob3')
+        self.assertTrue(os.path.exists(path1))
+        self.assertFalse(os.path.exists(path2))
+        self.assertTrue(os.path.exists(path3))
+
+    def test_job_data_download_file(self):
+        job_data = MockJobData('connection_string', blob_cache=self.cache)
+        job_data.blob_store = self.blob_store
+        self.assertEqual(job_data.download_file('inputs', 'blob1', self.read), b'version 1')
+        self.assertEqual(job_data.download_file('inputs', 'blob1', self.read), b'version 1')
+        self.assertIsNone(job_data.download_file('inputs', 'missing', self.read))
+        self.assertEqual(self.blob_store.downloads, 1)
+
+    def test_job_data_upload_file_outside_cache(self):
+        job_data = MockJobData('connection_string', blob_cache=self.cache)
+        job_data.blob_store = self.blob_store
+        job_data.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, job_data.temp_dir)
+        self.assertEqual(job_data.download_file('inputs', 'blob1', self.read), b'version 1')
+
+        # The blob is recreated from a temp file outside the cache, the older cached copy is replaced with it
+        del self.blob_store.blobs[('inputs', 'blob1')]
+
+        def create_file(file_path):
+            with open(file_path, 'wb') as f:
+                f.write(b'version 2')
+            return True
+        self.assertTrue(job_data.upload_file('inputs', 'blob1', create_file))
+        self.assertEqual(job_data.download_file('inputs', 'blob1', self.read), b'version 2')
+        self.assertEqual((self.cache.hits, self.blob_store.downloads), (1, 1))
+
+    def test_cache_dir_separate_from_temp_dir(self):
+        self.assertNotEqual(LocalBlobCache().cache_dir, TEMP_DIR)
+        conn_str = 'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=a2V5;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;'
+        self.assertRaises(ValueError, JobData, conn_str, temp_dir=self.cache_dir + '/', blob_cache=self.cache)
+
+    def test_job_data_open_mapped(self):
+        job_data = MockJobData('connection_string', blob_cache=self.cache)
+        job_data.blob_store = self.blob_store
+        self.blob_store.put('inputs', 'empty', b'')
+
+        mapped = job_data.open_mapped('inputs', 'blob1')
+        self.assertEqual(mapped[:7], b'version')
+        self.assertRaises(TypeError, mapped.__setitem__, 0, 86)
+        # The map stays valid when the cached copy is replaced
+        self.blob_store.put('inputs', 'blob1', b'version 2')
+        remapped = job_data.open_mapped('inputs', 'blob1')
+        self.assertEqual(remapped[:], b'version 2')
+        self.assertEqual(mapped[:], b'version 1')
+        mapped.close()
+        remapped.close()
+
+        self.assertEqual(len(job_data.open_mapped('inputs', 'empty')), 0)
+        self.assertIsNone(job_data.open_mapped('inputs', 'missing'))
@@ -1,7 +1,10 @@
-from azure.core.exceptions import HttpResponseError
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+import glob
 import os
 import unittest
-from batch_job.blob_store import BlobStore
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+from batch_job.blob_store import BlobStore, DownloadResult, UploadResult
 
 
 @unittest.skip("Skip Azure Storage Emulator dependent tests")
@@ -104,3 +107,207 @@ class TestBlobStore(unittest.TestCase):
         # clean up the lease and the blob
         lease2.release()
         self.blob_store.delete(self.container_name, blob_name)
+
+
+class TestBlobStoreClient(unittest.TestCase):
+    def setUp(self):
+        self.patcher = patch('batch_job.blob_store.BlobServiceClient')
+        self.service_client_class = self.patcher.start()
+        self.service_client = self.service_client_class.from_connection_string.return_value
+        self.container = self.service_client.get_container_client.return_value
+        self.blob_client = self.container.get_blob_client.return_value
+        self.blob_client.exists.return_value = False
+        self.blob_store = BlobStore('UseDevelopmentStorage=true')
+        self.file_path = 'client_test_data.txt'
+        with open(self.file_path, 'wt') as f:
+            f.write('This is a test file.')
+
+    def tearDown(self):
+        self.patcher.stop()
+        os.remove(self.file_path)
+
+    def test_clients_and_container_existence_cached(self):
+        self.assertTrue(self.blob_store.upload('testcontainer', 'blob1', self.file_path))
+        self.assertTrue(self.blob_store.upload('testcontainer', 'blob2', self.file_path))
+        self.assertFalse(self.blob_store.exists('testcontainer', 'blob1'))
+
+        self.service_client_class.from_connection_string.assert_called_once()
+        self.service_client.get_container_client.assert_called_once_with('testcontainer')
+        self.container.create_container.assert_called_once()
+
+    def test_read_paths_do_not_create_container(self):
+        error = ResourceNotFoundError('The specified container does not exist.')
+        error.error_code = 'ContainerNotFound'
+        self.blob_client.download_blob.side_effect = error
+        self.blob_client.delete_blob.side_effect = error
+
+        self.assertFalse(self.blob_store.exists('missingcontainer', 'blob1'))
+        self.assertFalse(self.blob_store.download('missingcontainer', 'blob1', 'not_downloaded.txt'))
+        self.assertFalse(self.blob_store.delete('missingcontainer', 'blob1'))
+        self.assertFalse(os.path.exists('not_downloaded.txt'))
+        self.container.create_container.assert_not_called()
+
+    def test_container_not_found_invalidates_cache(self):
+        error = ResourceNotFoundError('The specified container does not exist.')
+        error.error_code = 'ContainerNotFound'
+        self.blob_client.upload_blob.side_effect = [None, error, None]
+
+        self.assertTrue(self.blob_store.upload('testcontainer', 'blob1', self.file_path))
+        # The container is deleted behind the cache, the upload recreates it and retries.
+        self.assertTrue(self.blob_store.upload('testcontainer', 'blob2', self.file_path))
+        self.assertEqual(self.container.create_container.call_count, 2)
+        self.assertEqual(self.blob_client.upload_blob.call_count, 3)
+
+    def test_upload_is_conditional_create(self):
+        self.blob_client.upload_blob.side_effect = [{'etag': '"0x1"'}, ResourceExistsError('The specified blob already exists.')]
+
+        result = self.blob_store.upload('testcontainer', 'blob1', self.file_path)
+        self.assertEqual((result.status, result.etag), (UploadResult.Created, '"0x1"'))
+        result = self.blob_store.upload('testcontainer', 'blob1', self.file_path, max_concurrency=8)
+        self.assertFalse(result)
+        self.assertEqual(result.status, UploadResult.AlreadyExists)
+        self.assertEqual(self.blob_store.upload('testcontainer', 'blob1', 'not_existing.txt').status, UploadResult.FileNotFound)
+
+        # No existence probe, the service rejects the upload if the blob exists
+        self.blob_client.exists.assert_not_called()
+        self.assertEqual([call.kwargs['max_concurrency'] for call in self.blob_client.upload_blob.call_args_list], [4, 8])
+        self.assertFalse(any(call.kwargs['overwrite'] for call in self.blob_client.upload_blob.call_args_list))
+
+    def test_upload_bytes_and_stream(self):
+        uploaded = []
+        self.blob_client.upload_blob.side_effect = lambda data, **kwargs: uploaded.append((data if isinstance(data, bytes) else \
+            data.read() if hasattr(data, 'read') else b''.join(data), kwargs['length']))
+        buffer = bytearray(b'--in memory--')
+        data = b'bytes'
+
+        self.assertTrue(self.blob_store.upload_bytes('testcontainer', 'blob1', memoryview(buffer)[2:-2]))
+        self.assertTrue(self.blob_store.upload_bytes('testcontainer', 'blob2', data))
+        # bytes are handed to the SDK as they are
+        self.assertIs(self.blob_client.upload_blob.call_args.args[0], data)
+        self.assertTrue(self.blob_store.upload_stream('testcontainer', 'blob3', (chunk for chunk in [b'chunk1', b'chunk2'])))
+        self.assertEqual(uploaded, [(b'in memory', 9), (b'bytes', 5), (b'chunk1chunk2', None)])
+        self.assertFalse(any(call.kwargs['overwrite'] for call in self.blob_client.upload_blob.call_args_list))
+
+    def test_upload_stream_container_not_found(self):
+        error = ResourceNotFoundError('The specified container does not exist.')
+        error.error_code = 'ContainerNotFound'
+        reads = []
+
+        # A seekable stream is read again from where it started, a generator can not be
+        def upload_blob(data, **kwargs):
+            reads.append(data if isinstance(data, bytes) else data.read(4) if hasattr(data, 'read') else next(data))
+            if len(reads) % 2:
+                raise error
+        self.blob_client.upload_blob.side_effect = upload_blob
+        self.assertTrue(self.blob_store.upload_bytes('testcontainer', 'blob1', b'data'))
+        self.assertRaises(ResourceNotFoundError, self.blob_store.upload_stream, 'testcontainer', 'blob2', iter([b'gen1', b'gen2']))
+        self.assertEqual(reads, [b'data', b'data', b'gen1'])
+        # The container is recreated by the next upload
+        self.assertEqual(self.container.create_container.call_count, 2)
+        self.assertNotIn('testcontainer', self.blob_store._existing_containers)
+
+    def test_download_bytes_and_open_read_stream(self):
+        self.blob_client.download_blob.return_value.readall.return_value = b'in memory'
+        self.assertEqual(self.blob_store.download_bytes('testcontainer', 'blob1'), b'in memory')
+        self.assertIs(self.blob_store.open_read_stream('testcontainer', 'blob1', max_concurrency=8), self.blob_client.download_blob.return_value)
+        self.blob_client.download_blob.assert_called_with(max_concurrency=8)
+
+        self.blob_client.download_blob.side_effect = ResourceNotFoundError('The specified blob does not exist.')
+        self.assertIsNone(self.blob_store.download_bytes('testcontainer', 'blob2'))
+        self.assertIsNone(self.blob_store.open_read_stream('testcontainer', 'blob2'))
+        self.container.create_container.assert_not_called()
+
+    def test_exists_many(self):
+        # Day 11 is missing, the listing stops at the first name after day 11
+        listed = ['data/202401{0:02d}'.format(day) for day in [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 13]]
+        self.container.list_blob_names.return_value = iter(listed)
+        self.blob_client.exists.return_value = True
+        blob_ids = [('inputs', 'data/202401{0:02d}'.format(day)) for day in range(1, 12)] + [('other', 'blob1')]
+
+        self.assertEqual(self.blob_store.exists_many(blob_ids), set(blob_ids) - {('inputs', 'data/20240111')})
+        self.container.list_blob_names.assert_called_once_with(name_starts_with='data/202401')
+        # Only the single blob of the other container is checked with its own request
+        self.blob_client.exists.assert_called_once()
+
+    def test_exists_many_caps_the_listing(self):
+        # Each day folder holds 300 part files besides its _SUCCESS marker, day 2 has no marker
+        listed = sorted('data/202401{0:02d}/part-{1:04d}'.format(day, part) for day in range(1, 13) for part in range(300))
+        listed = sorted(listed + ['data/202401{0:02d}/_SUCCESS'.format(day) for day in range(1, 13) if day != 2])
+        self.container.list_blob_names.return_value = iter(listed)
+        self.blob_client.exists.return_value = True
+        blob_ids = [('inputs', 'data/202401{0:02d}/_SUCCESS'.format(day)) for day in range(1, 11)]
+
+        # The listing stops after 1000 names, within the part files of day 4, and the markers of days 5 to 10 are checked one by one
+        self.assertEqual(self.blob_store.exists_many(blob_ids), set(blob_ids) - {('inputs', 'data/20240102/_SUCCESS')})
+        self.assertEqual(self.blob_client.exists.call_count, 6)
+
+    def test_download_streams_to_file(self):
+        self.blob_client.download_blob.return_value.readinto.side_effect = lambda stream: stream.write(b'streamed data')
+        self.assertTrue(self.blob_store.download('testcontainer', 'blob1', 'downloaded.txt', max_concurrency=8))
+        with open('downloaded.txt', 'rb') as f:
+            self.assertEqual(f.read(), b'streamed data')
+        os.remove('downloaded.txt')
+        self.blob_client.download_blob.assert_called_once_with(max_concurrency=8)
+        self.blob_client.download_blob.return_value.readall.assert_not_called()
+
+    def test_failed_download_leaves_no_file(self):
+        def fail_midway(stream):
+            stream.write(b'partial')
+            raise ConnectionError('Connection reset')
+        self.blob_client.download_blob.return_value.readinto.side_effect = fail_midway
+        self.assertRaises(ConnectionError, self.blob_store.download, 'testcontainer', 'blob1', 'downloaded.txt')
+        self.assertFalse(os.path.exists('downloaded.txt'))
+        self.assertEqual(glob.glob('downloaded.txt.*'), [])
+
+    def test_download_not_modified(self):
+        # The SDK raises a 304 as ResourceModifiedError when the response has an error code, otherwise as HttpResponseError.
+        for error in [ResourceModifiedError('The condition specified using HTTP conditional header(s) is not met.'), HttpResponseError('Not Modified')]:
+            error.status_code = 304
+            self.blob_client.download_blob.side_effect = error
+            result = self.blob_store.download('testcontainer', 'blob1', 'downloaded.txt', if_none_match='"etag1"')
+            self.assertEqual(result.status, DownloadResult.NotModified)
+            self.assertEqual(result.etag, '"etag1"')
+            self.assertFalse(os.path.exists('downloaded.txt'))
+
+        error = HttpResponseError('Server busy')
+        error.status_code = 503
+        self.blob_client.download_blob.side_effect = error
+        self.assertRaises(HttpResponseError, self.blob_store.download, 'testcontainer', 'blob1', 'downloaded.txt', if_none_match='"etag1"')
+
+    def test_concurrent_downloads_write_separate_partial_files(self):
+        partial_paths = []
+        def download_other_midway(stream):
+            # Another download of the same blob to the same path fails while this one is in progress.
+            partial_paths.append(stream.name)
+            self.blob_client.download_blob.return_value.readinto.side_effect = fail_midway
+            self.assertRaises(ConnectionError, self.blob_store.download, 'testcontainer', 'blob1', 'downloaded.txt')
+            stream.write(b'streamed data')
+        def fail_midway(stream):
+            partial_paths.append(stream.name)
+            stream.write(b'other')
+            raise ConnectionError('Connection reset')
+        self.blob_client.download_blob.return_value.readinto.side_effect = download_other_midway
+        self.blob_store.download('testcontainer', 'blob1', 'downloaded.txt')
+        with open('downloaded.txt', 'rb') as f:
+            self.assertEqual(f.read(), b'streamed data')
+        os.remove('downloaded.txt')
+        self.assertNotEqual(partial_paths[0], partial_paths[1])
+        self.assertEqual(glob.glob('downloaded.txt.*'), [])
+
+    def test_clean_up_in_batches(self):
+        blobs = [SimpleNamespace(name='logs/2024{0:04d}'.format(i), size=10) for i in range(600)]
+        self.container.list_blobs.return_value = iter(blobs)
+        self.container.delete_blobs.side_effect = lambda *names, **kwargs: [MagicMock(status_code=404 if name == 'logs/20240007' else 202) for name in names]
+
+        result = self.blob_store.clean_up('testcontainer', 'logs/20240300', prefix='logs/')
+        self.container.list_blobs.assert_called_once_with(name_starts_with='logs/')
+        self.assertEqual([len(call.args) for call in self.container.delete_blobs.call_args_list], [256, 44])
+        self.assertEqual((result.deleted, result.bytes_freed, result.failed, result.stopped_early), (299, 2990, 0, False))
+
+    def test_clean_up_with_max_deletes(self):
+        self.container.list_blobs.return_value = iter([SimpleNamespace(name='blob{0}'.format(i), size=None) for i in range(5)])
+        self.container.delete_blobs.side_effect = lambda *names, **kwargs: [MagicMock(status_code=202 if name != 'blob1' else 403) for name in names]
+
+        result = self.blob_store.clean_up('testcontainer', 'blob9', max_deletes=3)
+        self.container.delete_blobs.assert_called_once_with('blob0', 'blob1', 'blob2', raise_on_any_failure=False)
+        self.assertEqual((result.deleted, result.bytes_freed, result.failed, result.stopped_early), (2, 0, 1, True))
@@ -0,0 +1,82 @@
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from batch_job.exists_cache import ExistsCache
+from tests.mock_data import MockJobData
+
+
+class TestExistsCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ExistsCache(positive_ttl=60, negative_ttl=0.05)
+        self.job_data = MockJobData('connection_string', exists_cache=self.cache)
+        self.job_data.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.job_data.temp_dir)
+
+    def test_ttl_and_stats(self):
+        self.cache.put(('c', 'found'), True)
+        self.cache.put(('c', 'missing'), False)
+        self.assertTrue(self.cache.get(('c', 'found')))
+        self.assertFalse(self.cache.get(('c', 'missing')))
+        time.sleep(0.06)
+        # The negative result expires much sooner
+        self.assertTrue(self.cache.get(('c', 'found')))
+        self.assertIsNone(self.cache.get(('c', 'missing')))
+        self.assertIsNone(self.cache.get(('c', 'unknown')))
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 2))
+
+    def test_files_exist_only_checks_uncached(self):
+        self.job_data.blob_store.exists_many = MagicMock(side_effect=lambda blob_ids: { ('test_container1', 'test_blob1') } & set(blob_ids))
+        blob_ids = [('test_container1', 'test_blob1'), ('test_container1', 'test_blob3')]
+        self.assertEqual(self.job_data.files_exist(blob_ids), { ('test_container1', 'test_blob1') })
+        self.assertEqual(self.job_data.files_exist(blob_ids), { ('test_container1', 'test_blob1') })
+        self.job_data.blob_store.exists_many.assert_called_once_with(blob_ids)
+
+    def test_writes_invalidate(self):
+        def create_file(file_path):
+            with open(file_path, 'wt') as f:
+                f.write('test')
+            return True
+
+        self.assertFalse(self.job_data.file_exists('test_container3', 'test_blob3'))
+        self.assertTrue(self.job_data.upload_file('test_container3', 'test_blob3', create_file))
+        self.assertTrue(self.job_data.file_exists('test_container3', 'test_blob3'))
+        self.job_data.delete_file('test_container3', 'test_blob3')
+        self.assertFalse(self.job_data.file_exists('test_container3', 'test_blob3'))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 3))
+
+    def test_check_during_write_is_not_cached(self):
+        delete = self.job_data.blob_store.delete
+
+        def delete_with_check(container_name, blob_name):
+            # Another worker checks the blob while it is being deleted
+            self.assertTrue(self.job_data.file_exists(container_name, blob_name))
+            return delete(container_name, blob_name)
+        self.job_data.blob_store.delete = delete_with_check
+
+        self.job_data.delete_file('test_container1', 'test_blob1')
+        self.assertFalse(self.job_data.file_exists('test_container1', 'test_blob1'))
+
+    def test_check_finishing_after_write_is_not_cached(self):
+        blob_id = ('test_container1', 'test_blob1')
+        exists = self.job_data.blob_store.exists
+
+        def exists_then_deleted(container_name, blob_name):
+            # The check sees the blob, then another worker deletes it before the result is cached
+            found = exists(container_name, blob_name)
+            self.job_data.blob_store.exists = exists
+            self.job_data.delete_file(container_name, blob_name)
+            return found
+        self.job_data.blob_store.exists = exists_then_deleted
+        self.assertTrue(self.job_data.file_exists(*blob_id))
+        self.assertFalse(self.job_data.file_exists(*blob_id))
+
+        self.job_data.blob_store.exists_many = MagicMock(side_effect=lambda blob_ids: self.job_data.delete_file(*blob_id) or { blob_id })
+        self.job_data.invalidate_exists(*blob_id)
+        self.assertEqual(self.job_data.files_exist([blob_id]), { blob_id })
+        self.job_data.blob_store.exists_many = MagicMock(return_value=set())
+        self.assertEqual(self.job_data.files_exist([blob_id]), set())
@@ -1,8 +1,11 @@
+import asyncio
 import unittest
 from datetime import datetime, timedelta, timezone
 import pickle
 import time
+from unittest.mock import MagicMock
 
+from batch_job.async_base_job import AsyncBaseJob
 from batch_job.job_data import JobStatus
 from batch_job.job_runner import JobRunner
 from batch_job.job_settings import JobSettingsFactory, BaseJob, JobSchedule
@@ -35,6 +38,30 @@ class TesterJob(BaseJob):
             raise Exception('Invalid result')
 
 
+class AsyncTesterJob(AsyncBaseJob):
+    async def load_items(self, last_processed: str):
+        start = int(last_processed) + 1 if last_processed else 1
+        return start + 5 > 10, range(start, start + 5)
+
+    async def process_item(self, item) -> bool:
+        await asyncio.sleep(0.01 * (5 - item % 5))
+        self.job_states['result'] = self.job_states.get('result', 0) + item
+        return True
+
+
+class CrashingTesterJob(BaseJob):
+    crash_at = None
+
+    def load_items(self, last_processed: str):
+        start = int(last_processed) + 1 if last_processed else 1
+        return True, range(start, 11)
+
+    def process_item(self, item) -> bool:
+        if item == CrashingTesterJob.crash_at:
+            raise KeyboardInterrupt() # the process is killed, nothing is saved by the job
+        return True
+
+
 class TestJobRunner(unittest.TestCase):
     def setUp(self):
         test_settings = {
@@ -42,6 +69,16 @@ class TestJobRunner(unittest.TestCase):
                 'job_class': 'batch_job.job_settings.BaseJob',
                 'job_type': 'BaseJob1'
             },
+            'AsyncTestJob1': {
+                'job_class': 'tests.test_job_runner.AsyncTesterJob',
+                'job_type': 'AsyncTestJob1',
+                'max_workers': 3
+            },
+            'CrashingTestJob1': {
+                'job_class': 'tests.test_job_runner.CrashingTesterJob',
+                'job_type': 'CrashingTestJob1',
+                'checkpoint_items': 2
+            },
             'TestJob1': {
                 'job_class': 'tests.test_job_runner.TesterJob',
                 'job_type': 'TestJob1',
@@ -51,6 +88,12 @@ class TestJobRunner(unittest.TestCase):
         }
         self.job_runner = JobRunner(JobSettingsFactory(test_settings), MockJobData('connection_string'))
 
+    def create_legacy_info(self, settings, revision: int, current_time: datetime):
+        # An info written before the failure counters, the runs inserted directly are counted by a backfill.
+        info = settings.create_info(revision, current_time)
+        del info['consecutive_failures'], info['total_failures']
+        return info
+
     def validate_info(self, job_id: str, property_names: list[str], expected_values: list, compare_properties: list [tuple[str, str]] = [],
                       states_property_names: list[str] = [], states_expected_values: list = []):
         info = self.job_runner.job_data.get_info(job_id)
@@ -66,7 +109,7 @@ class TestJobRunner(unittest.TestCase):
         return info
 
     def validate_run(self, job_id: str, expected_count: int, property_names: list[str], expected_values: list, compare_properties: list [tuple[str, str]] = []):
-        runs = self.job_runner.job_data.list_runs(job_id)
+        runs = list(self.job_runner.job_data.list_runs(job_id))
         self.assertEqual(len(runs), expected_count)
         if expected_count > 0:
             for i in range(len(property_names)):
@@ -169,7 +212,7 @@ class TestJobRunner(unittest.TestCase):
         current_time = datetime.now(timezone.utc)
         revision = 2
         settings = self.job_runner.settings_factory.create(job_type)
-        info = settings.create_info(revision, current_time)
+        info = self.create_legacy_info(settings, revision, current_time)
         self.job_runner.job_data.upsert_info(info)
         # Maximum consecutive failures are 2
         self.job_runner.job_data.insert_run(info['RowKey'], current_time - timedelta(hours=1), current_time - timedelta(minutes=55), 'fail1', JobStatus.Suspended, True)
@@ -189,7 +232,7 @@ class TestJobRunner(unittest.TestCase):
         current_time = datetime.now(timezone.utc)
         revision = 3
         settings = self.job_runner.settings_factory.create(job_type)
-        info = settings.create_info(revision, current_time)
+        info = self.create_legacy_info(settings, revision, current_time)
         info['status'] = JobStatus.Suspended
         states = pickle.loads(info['states'])
         states['last_processed'] = '80'
@@ -274,4 +317,116 @@ class TestJobRunner(unittest.TestCase):
         job_id = info['RowKey']
         self.validate_info(job_id, ['status', 'revision'], [JobStatus.Suspended, revision], [], ['last_processed', 'result', 'processed', 'skipped'], ['0', 0, 1, 2])
         self.validate_run(job_id, 1, ['end_status', 'is_error'], [JobStatus.Suspended, False])
-    
\ No newline at end of file
+    
+    def test_list_active_infos_and_info_exists(self):
+        job_type = 'TestJob1'
+        settings = self.job_runner.settings_factory.create(job_type)
+        job_data = self.job_runner.job_data
+        statuses = [JobStatus.Pending, JobStatus.Completed, JobStatus.Suspended, JobStatus.Failed, JobStatus.Expired, JobStatus.Active]
+        for revision, status in enumerate(statuses):
+            info = settings.create_info(revision, datetime(2023, 1, 1, tzinfo=timezone.utc))
+            info['status'] = status
+            job_data.upsert_info(info)
+
+        # Only the infos not in an end state are returned, with the selected columns only
+        active_infos = list(job_data.list_active_infos(settings.get_job_partition(), ['RowKey', 'status']))
+        self.assertEqual([info['status'] for info in active_infos], [JobStatus.Pending, JobStatus.Suspended, JobStatus.Active])
+        self.assertTrue(all('inputs' not in info for info in active_infos))
+
+        self.assertTrue(job_data.info_exists(settings.get_job_id(datetime(2023, 1, 1), 1)))
+        self.assertFalse(job_data.info_exists(settings.get_job_id(datetime(2023, 1, 2), 1)))
+
+    def test_new_job_killed_after_checkpoint_is_resumed(self):
+        job_type = 'CrashingTestJob1'
+        settings = self.job_runner.settings_factory.create(job_type)
+        job_id = settings.get_job_id(datetime.now(timezone.utc), 0)
+        CrashingTesterJob.crash_at = 5
+        self.addCleanup(setattr, CrashingTesterJob, 'crash_at', None)
+        self.assertRaises(KeyboardInterrupt, self.job_runner.run, job_type)
+
+        # The first checkpoint stored the whole info of the new job
+        info = self.validate_info(job_id, ['status', 'revision', 'consecutive_failures'], [JobStatus.Active, 0, 0], [], ['last_processed', 'processed'], ['4', 4])
+        self.assertIsNotNone(info['create_time'])
+        self.assertIsNotNone(pickle.loads(info['inputs']))
+
+        # The next run resumes it from the checkpoint instead of crashing or creating it again, its checkpoints only merge the states
+        CrashingTesterJob.crash_at = None
+        job_data = self.job_runner.job_data
+        job_data.upsert_info = MagicMock(wraps=job_data.upsert_info)
+        job_data.checkpoint_states = MagicMock(wraps=job_data.checkpoint_states)
+        self.job_runner.run(job_type)
+        self.assertEqual(job_data.checkpoint_states.call_count, 3)
+        job_data.upsert_info.assert_called_once() # by complete_run
+        self.assertEqual(self.job_runner.run_success, [job_id])
+        self.validate_info(job_id, ['status'], [JobStatus.Completed], [], ['last_processed', 'processed'], ['10', 10])
+        self.validate_run(job_id, 1, ['end_status'], [JobStatus.Completed])
+
+    def test_failure_counters_kept_and_backfilled(self):
+        job_type = 'TestJob1'
+        current_time = datetime.now(timezone.utc)
+        settings = self.job_runner.settings_factory.create(job_type)
+        job_data = self.job_runner.job_data
+        info = self.create_legacy_info(settings, 7, current_time)
+        job_data.upsert_info(info)
+        job_id = info['RowKey']
+        job_data.insert_run(job_id, current_time - timedelta(hours=1), current_time - timedelta(minutes=55), 'fail1', JobStatus.Suspended, True)
+
+        # The info written without counters is backfilled once from the runs
+        self.assertEqual(job_data.backfill_all_failures(settings.get_job_partition()), 1)
+        self.validate_info(job_id, ['consecutive_failures', 'total_failures'], [1, 1])
+        self.assertEqual(job_data.backfill_all_failures(settings.get_job_partition()), 0)
+
+        # complete_run keeps the counters, summarize_failures reads them without scanning the runs
+        job_data.complete_run(False, job_data.get_info(job_id), 'fail2', current_time)
+        self.validate_info(job_id, ['consecutive_failures', 'total_failures'], [2, 2])
+        job_data.complete_run(True, job_data.get_info(job_id), 'good1', current_time)
+        info = self.validate_info(job_id, ['consecutive_failures', 'total_failures'], [0, 2])
+        job_data.list_runs = MagicMock()
+        self.assertEqual(job_data.summarize_failures(info), (0, 2))
+        job_data.list_runs.assert_not_called()
+
+    def test_latest_runs_with_inverted_and_legacy_keys(self):
+        job_data = MockJobData('connection_string')
+        job_id = '20230101_1000000_TestJob1_1000001'
+        start_time = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        for i in range(3):
+            job_data.insert_run(job_id, start_time, start_time + timedelta(minutes=i), 'legacy{0}'.format(i), JobStatus.Suspended)
+        job_data.inverted_run_keys = True
+        for i in range(3, 6):
+            job_data.insert_run(job_id, start_time, start_time + timedelta(minutes=i), 'inverted{0}'.format(i), JobStatus.Suspended)
+
+        # The latest inverted runs are read first, the legacy runs fill the rest from the newest
+        self.assertEqual([run['message'] for run in job_data.latest_runs(job_id, 2)], ['inverted5', 'inverted4'])
+        self.assertEqual([run['message'] for run in job_data.latest_runs(job_id, 5)], ['inverted5', 'inverted4', 'inverted3', 'legacy2', 'legacy1'])
+        self.assertEqual(len(job_data.latest_runs(job_id, 10)), 6)
+
+    def test_bulk_expire_and_insert_runs(self):
+        job_type = 'TestJob1'
+        current_time = datetime.now(timezone.utc)
+        settings = self.job_runner.settings_factory.create(job_type)
+        job_data = self.job_runner.job_data
+        infos = [settings.create_info(revision, current_time) for revision in range(10, 15)]
+        for info in infos:
+            job_data.upsert_info(info)
+            job_data.insert_runs([job_data.create_run(info['RowKey'], current_time, current_time + timedelta(seconds=i), 'run', JobStatus.Pending) for i in range(3)])
+
+        job_data.info_store.submit_transaction = MagicMock(wraps=job_data.info_store.submit_transaction)
+        job_data.expire_jobs(infos, current_time)
+
+        job_data.info_store.submit_transaction.assert_called_once()
+        for info in infos:
+            self.validate_info(info['RowKey'], ['status', 'revision'], [JobStatus.Expired, info['revision']])
+            self.validate_run(info['RowKey'], 3, ['end_status'], [JobStatus.Pending])
+
+    def test_run_async_job_to_completion(self):
+        job_type = 'AsyncTestJob1'
+        settings = self.job_runner.settings_factory.create(job_type)
+        job_id = settings.get_job_id(datetime.now(timezone.utc), 0)
+
+        self.job_runner.run(job_type)
+        self.assertTrue(job_id in self.job_runner.run_success)
+        self.validate_info(job_id, ['status'], [JobStatus.Suspended], [], ['last_processed', 'result', 'processed'], ['5', 15, 5])
+
+        self.job_runner.run(job_type)
+        self.validate_info(job_id, ['status'], [JobStatus.Completed], [], ['last_processed', 'result', 'processed'], ['10', 55, 10])
+        self.validate_run(job_id, 2, ['end_status', 'is_error'], [JobStatus.Completed, False])
@@ -0,0 +1,41 @@
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from batch_job.rate_limiter import ThrottledError, TokenBucket, get_retry_after, is_throttled
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_is_throttled(self):
+        self.assertTrue(is_throttled(ThrottledError()))
+        self.assertTrue(is_throttled(MagicMock(spec=Exception, status_code=429)))
+        self.assertTrue(is_throttled(MagicMock(spec=Exception, status_code=None, response=MagicMock(status_code=429))))
+        self.assertFalse(is_throttled(ValueError('bad item')))
+
+    def test_get_retry_after(self):
+        self.assertEqual(get_retry_after(ThrottledError(retry_after=2)), 2)
+        self.assertEqual(get_retry_after(MagicMock(spec=Exception, retry_after=None, response=MagicMock(headers={'Retry-After': '3'}))), 3)
+        self.assertIsNone(get_retry_after(ValueError('bad item')))
+
+    def test_token_bucket_rate(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        # The burst is available right away, then one token per 0.1 second
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.01)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, delta=0.01)
+
+    def test_token_bucket_unlimited(self):
+        bucket = TokenBucket()
+        self.assertEqual(sum(bucket.reserve() for _ in range(100)), 0)
+
+    def test_token_bucket_throttle(self):
+        bucket = TokenBucket()
+        self.assertEqual(bucket.throttle(), 0.5)
+        self.assertEqual(bucket.throttle(), 1.0)
+        self.assertGreater(bucket.reserve(), 0.9)
+        bucket.succeed()
+        self.assertEqual(bucket.throttle(0.05), 0.05)
+        start = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
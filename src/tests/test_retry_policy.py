@@ -0,0 +1,21 @@
+import unittest
+
+from batch_job.retry_policy import RetryPolicy
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_should_retry(self):
+        policy = RetryPolicy(max_attempts=3, retryable=(ConnectionError, TimeoutError))
+        self.assertTrue(policy.should_retry(ConnectionError(), 1))
+        self.assertTrue(policy.should_retry(TimeoutError(), 2))
+        self.assertFalse(policy.should_retry(TimeoutError(), 3))
+        self.assertFalse(policy.should_retry(ValueError(), 1))
+        self.assertFalse(RetryPolicy().should_retry(ConnectionError(), 1))
+
+    def test_get_delay(self):
+        policy = RetryPolicy(max_attempts=10, base_seconds=0.5, max_seconds=3)
+        for _ in range(20):
+            self.assertLessEqual(policy.get_delay(1), 0.5)
+            self.assertLessEqual(policy.get_delay(3), 2)
+            self.assertLessEqual(policy.get_delay(8), 3)
+            self.assertGreaterEqual(policy.get_delay(8), 0)
@@ -1,6 +1,7 @@
 from batch_job.table_store import TableStore, UpdateMode
 from typing_extensions import TypedDict
 import unittest
+from unittest.mock import MagicMock, patch
 
 
 class EntityType(TypedDict):
@@ -98,3 +99,65 @@ class TestTableStore(unittest.TestCase):
         self.assertIsNotNone(ger9)
         self.assertEqual(ger9.get("value"), "test8") # value from data8 is retained as merge mode is used
         self.assertEqual(ger9.get("status"), "merged")
+
+
+class TestTableStoreClient(unittest.TestCase):
+    @patch('batch_job.table_store.TableServiceClient')
+    def test_client_reused_and_closed(self, service_client_class):
+        service_client = service_client_class.from_connection_string.return_value
+        table_client = service_client.get_table_client.return_value
+        table_client.get_entity.return_value = {"PartitionKey": "pk1", "RowKey": "rk1"}
+
+        with TableStore("UseDevelopmentStorage=true", "TestTable") as table_store:
+            table_store.insert_entity({"PartitionKey": "pk1", "RowKey": "rk1"})
+            table_store.get_entity("pk1", "rk1")
+            table_store.query_entities("pk1")
+
+        # One service client and one table client serve all the calls, and both are closed on exit
+        service_client_class.from_connection_string.assert_called_once()
+        service_client.get_table_client.assert_called_once_with("TestTable")
+        table_client.close.assert_called_once()
+        service_client.close.assert_called_once()
+
+    def test_shared_service_client_not_closed(self):
+        service_client = MagicMock()
+        info_store = TableStore("UseDevelopmentStorage=true", "JobInfo", service_client)
+        run_store = TableStore("UseDevelopmentStorage=true", "JobRun", service_client)
+        info_store.get_entity("pk1", "rk1")
+        run_store.get_entity("pk1", "rk1")
+        info_store.close()
+        run_store.close()
+
+        self.assertEqual(service_client.get_table_client.call_count, 2)
+        service_client.close.assert_not_called()
+
+    def test_query_pages_with_projection_and_filter(self):
+        service_client = MagicMock()
+        pager = service_client.get_table_client.return_value.query_entities.return_value.by_page.return_value
+        pager.__iter__.return_value = iter([[{"RowKey": "rk1"}, {"RowKey": "rk2"}], [{"RowKey": "rk3"}]])
+        pager.continuation_token = None
+        table_store = TableStore("UseDevelopmentStorage=true", "TestTable", service_client)
+
+        entities = table_store.iter_entities("pk1", "rk0", select=["RowKey"], results_per_page=2,
+                                             query_filter="status ne @s", parameters={"s": "completed"})
+        self.assertEqual([entity["RowKey"] for entity in entities], ["rk1", "rk2", "rk3"])
+
+        query_entities = service_client.get_table_client.return_value.query_entities
+        query_entities.assert_called_once_with("PartitionKey eq @pk and RowKey gt @rkt and (status ne @s)",
+                                               parameters={"s": "completed", "pk": "pk1", "rkt": "rk0"}, select=["RowKey"], results_per_page=2)
+        query_entities.return_value.by_page.assert_called_once_with(continuation_token=None)
+
+    def test_submit_transaction_grouped_and_chunked(self):
+        service_client = MagicMock()
+        table_client = service_client.get_table_client.return_value
+        table_client.submit_transaction.side_effect = lambda operations: [{} for _ in operations]
+        table_store = TableStore("UseDevelopmentStorage=true", "TestTable", service_client)
+
+        operations = [('create', {"PartitionKey": "pk{0}".format(i % 2), "RowKey": str(i)}) for i in range(250)]
+        results = table_store.submit_transaction(operations)
+
+        self.assertEqual(len(results), 250)
+        chunks = [call.args[0] for call in table_client.submit_transaction.call_args_list]
+        self.assertEqual([len(chunk) for chunk in chunks], [100, 25, 100, 25])
+        for chunk in chunks:
+            self.assertEqual(len(set(operation[1]["PartitionKey"] for operation in chunk)), 1)